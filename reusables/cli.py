@@ -9,12 +9,11 @@
 from __future__ import absolute_import
 import os
 import logging
-import shutil
 from collections import deque
 
 from reusables.shared_variables import win_based, python_version
 from reusables.process_helpers import run
-from reusables.file_operations import find_files_list
+from reusables.file_operations import find_files_list, copy_files
 from reusables.log import add_stream_handler
 
 __all__ = ["cmd", "pushd", "popd", "pwd", "cd", "ls", "find", "head", "cat", "tail", "cp"]
@@ -195,13 +194,15 @@ def tail(file_path, lines=10, encoding="utf-8", printed=True, errors="strict"):
         return data
 
 
-def cp(src, dst, overwrite=False):
+def cp(src, dst, overwrite=False, workers=None):
     """
     Copy files to a new location.
 
     :param src: list (or string) of paths of files to copy
     :param dst: file or folder to copy item(s) to
     :param overwrite: IF the file already exists, should I overwrite it?
+    :param workers: number of files to copy at once
+    :return: list of CopyResult for each file copied
     """
 
     if not isinstance(src, list):
@@ -213,11 +214,17 @@ def cp(src, dst, overwrite=False):
     if len(src) > 1 and not dst_folder:
         raise OSError("Cannot copy multiple item to same file")
 
+    to_copy = []
     for item in src:
         source = os.path.expanduser(item)
         destination = dst if not dst_folder else os.path.join(dst, os.path.basename(source))
         if not overwrite and os.path.exists(destination):
             _logger.warning("Not replacing {0} with {1}, overwrite not enabled".format(destination, source))
             continue
+        to_copy.append((source, destination))
 
-        shutil.copy(source, destination)
+    results = list(copy_files(to_copy, workers=workers))
+    for result in results:
+        if result.error:
+            raise result.error
+    return results
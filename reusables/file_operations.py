@@ -11,9 +11,26 @@ import logging
 import csv
 import json
 import hashlib
+import errno
+import mmap
 import glob
+import fnmatch
+import re
 import shutil
-from collections import defaultdict
+import sqlite3
+import threading
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import zlib
+import inspect
+import posixpath
+from collections import defaultdict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from itertools import islice, chain
 from pathlib import Path
 import warnings
 
@@ -22,8 +39,13 @@ try:
 except ImportError:
     import configparser as ConfigParser
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from reusables.namespace import ConfigNamespace
-from reusables.shared_variables import win_based, PY3, regex, variables, current_root
+from reusables.shared_variables import win_based, nix_based, PY3, regex, current_root
 
 __all__ = [
     "load_json",
@@ -31,29 +53,59 @@ __all__ = [
     "save_json",
     "csv_to_list",
     "extract",
+    "iter_archive",
     "archive",
     "config_dict",
     "config_namespace",
     "os_tree",
+    "DirectoryTree",
+    "directory_sizes",
     "check_filename",
     "count_files",
     "directory_duplicates",
     "dup_finder",
+    "DuplicateIndex",
+    "dedupe",
     "file_hash",
+    "HashCache",
+    "hash_files",
+    "file_hash_tree",
+    "TreeHash",
     "find_files",
     "find_files_list",
+    "scan_files",
+    "FileEntry",
+    "FileMatcher",
     "join_here",
     "join_paths",
     "remove_empty_directories",
     "remove_empty_files",
+    "remove_empty",
     "safe_filename",
     "safe_path",
     "touch",
     "sync_dirs",
+    "plan_sync",
+    "SyncPlan",
+    "SyncOperation",
+    "snapshot",
+    "Snapshot",
+    "SnapshotEntry",
+    "diff",
+    "DiffEntry",
+    "watch",
+    "WatchEvent",
+    "copy_file",
+    "copy_files",
+    "delta_copy",
+    "CopyResult",
 ]
 
 logger = logging.getLogger("reusables")
 
+FileEntry = namedtuple("FileEntry", ["path", "name", "size", "mtime_ns", "inode", "device"])
+FileEntry.__doc__ = """Lightweight file record yielded by scan_files, built from a single stat"""
+
 scandir_warning_given = False
 
 
@@ -66,7 +118,17 @@ def scandir_warning():
     )
 
 
-def extract(archive_file, path=".", delete_on_success=False, enable_rar=False):
+def extract(
+    archive_file,
+    path=".",
+    delete_on_success=False,
+    enable_rar=False,
+    name=None,
+    ext=None,
+    max_size=None,
+    matcher=None,
+    workers=None,
+):
     """
     Automatically detect archive type and extract all files to specified path.
 
@@ -82,11 +144,27 @@ def extract(archive_file, path=".", delete_on_success=False, enable_rar=False):
         os.listdir(".")
         # [ 'test_structure', 'test_structure.zip']
 
+    Only some files can be extracted by giving a name, ext, max_size or
+    matcher. Names and extensions are checked against the full path of the
+    member in the archive (so "*/README*" to match in any directory), and
+    only matching files are written, with the directories they are in.
+
+    ... code:: python
+
+        reusables.extract("build.tar.gz", path="logs", ext=".log", max_size=1024 ** 2)
+
+    The type of archive is found from the first bytes of the file. Zip files
+    can be extracted by multiple threads at once with workers.
 
     :param archive_file: path to file to extract
     :param path: location to extract to
     :param delete_on_success: Will delete the original archive if set to True
     :param enable_rar: include the rarfile import and extract
+    :param name: Part of the member path, or a glob pattern
+    :param ext: Extensions of the members to extract
+    :param max_size: Do not extract files larger than this many bytes
+    :param matcher: FileMatcher to use instead of name and ext
+    :param workers: number of threads to extract zip files with
     :return: path to extracted files
     """
 
@@ -95,13 +173,18 @@ def extract(archive_file, path=".", delete_on_success=False, enable_rar=False):
         raise OSError("File does not exist or has zero size")
 
     arch = None
-    if zipfile.is_zipfile(archive_file):
+    archive_type = _archive_type(archive_file)
+    if archive_type == "zip":
         logger.debug("File {0} detected as a zip file".format(archive_file))
         arch = zipfile.ZipFile(archive_file)
-    elif tarfile.is_tarfile(archive_file):
+    elif archive_type == "tar":
         logger.debug("File {0} detected as a tar file".format(archive_file))
-        arch = tarfile.open(archive_file)
-    elif enable_rar:
+        try:
+            arch = tarfile.open(archive_file)
+        except tarfile.ReadError:
+            # Compressed, but not a tar inside
+            arch = None
+    elif archive_type == "rar" and enable_rar:
         import rarfile
 
         if rarfile.is_rarfile(archive_file):
@@ -113,8 +196,18 @@ def extract(archive_file, path=".", delete_on_success=False, enable_rar=False):
 
     logger.debug("Extracting files to {0}".format(path))
 
+    wanted = _member_filter(name, ext, max_size, matcher)
     try:
-        arch.extractall(path=path)
+        members = None
+        if wanted and isinstance(arch, tarfile.TarFile):
+            # Iterate the tar lazily so it is only read through once
+            members = (m for m in arch if not m.isdir() and wanted(m.name, m.size))
+        elif wanted:
+            members = [m for m in arch.infolist() if not m.is_dir() and wanted(m.filename, m.file_size)]
+        if archive_type == "zip" and workers and workers > 1:
+            _zip_extract_parallel(arch, archive_file, arch.infolist() if members is None else members, path, workers)
+        else:
+            arch.extractall(path=path, members=members)
     finally:
         arch.close()
 
@@ -125,6 +218,137 @@ def extract(archive_file, path=".", delete_on_success=False, enable_rar=False):
     return os.path.abspath(path)
 
 
+def iter_archive(archive_file, enable_rar=False, name=None, ext=None, max_size=None, matcher=None):
+    """
+    Generator of (member info, readable stream) pairs for every file in a
+    zip, tar or rar archive, without extracting anything to disk. Member
+    info is the ZipInfo, TarInfo or RarInfo of the file.
+
+    Tar files are opened in stream mode ("r|*"), so even compressed tars
+    are only read once from front to back. That means each stream can only
+    be read until the next member is asked for, after which it is closed.
+
+    ... code:: python
+
+        for info, stream in reusables.iter_archive("build.tar.gz", ext=".so"):
+            digest = hashlib.sha256()
+            for block in iter(lambda: stream.read(1024 * 1024), b""):
+                digest.update(block)
+            print(info.name, digest.hexdigest())
+
+    :param archive_file: path to archive to read
+    :param enable_rar: include the rarfile import and read rar files
+    :param name: Part of the member path, or a glob pattern
+    :param ext: Extensions of the members to return
+    :param max_size: Skip files larger than this many bytes
+    :param matcher: FileMatcher to use instead of name and ext
+    :return: generator of (member info, stream) tuples
+    """
+    wanted = _member_filter(name, ext, max_size, matcher)
+    archive_type = _archive_type(archive_file)
+
+    if archive_type == "tar":
+        try:
+            arch = tarfile.open(archive_file, "r|*")
+        except tarfile.ReadError:
+            raise TypeError("File is not a known archive")
+        with arch:
+            for member in arch:
+                if not member.isfile() or (wanted and not wanted(member.name, member.size)):
+                    continue
+                stream = arch.extractfile(member)
+                try:
+                    yield member, stream
+                finally:
+                    stream.close()
+        return
+
+    if archive_type == "zip":
+        arch = zipfile.ZipFile(archive_file)
+    elif archive_type == "rar" and enable_rar:
+        import rarfile
+
+        arch = rarfile.RarFile(archive_file)
+    else:
+        raise TypeError("File is not a known archive")
+
+    with arch:
+        for info in arch.infolist():
+            if info.is_dir() or (wanted and not wanted(info.filename, info.file_size)):
+                continue
+            with arch.open(info) as stream:
+                yield info, stream
+
+
+_archive_magic = (
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"PK\x05\x06", "zip"),
+    (0, b"PK\x07\x08", "zip"),
+    (0, b"\x1f\x8b", "tar"),
+    (0, b"BZh", "tar"),
+    (0, b"\xfd7zXZ\x00", "tar"),
+    (257, b"ustar", "tar"),
+    (0, b"Rar!\x1a\x07", "rar"),
+)
+
+
+def _archive_type(archive_file):
+    """Tell zip, tar (including compressed tar) or rar files apart from their first bytes"""
+    with open(archive_file, "rb") as f:
+        header = f.read(262)
+    for offset, magic, archive_type in _archive_magic:
+        if header[offset : offset + len(magic)] == magic:
+            return archive_type
+    # Zip files can have anything in front of them, such as self extracting executables
+    if zipfile.is_zipfile(archive_file):
+        return "zip"
+    return None
+
+
+def _member_filter(name=None, ext=None, max_size=None, matcher=None):
+    """Build a function to check (member path, size) against extract filters, or None if there are none"""
+    if matcher is None and (name or ext):
+        matcher = FileMatcher(ext=ext, name=name)
+    if matcher is None and max_size is None:
+        return None
+
+    def wanted(member_name, size):
+        return (max_size is None or size <= max_size) and (matcher is None or matcher.match(member_name))
+
+    return wanted
+
+
+def _zip_extract_parallel(arch, archive_file, members, path, workers):
+    """
+    Extract zip members on a thread pool, each thread with its own handle to
+    the zip file. Directories are all made first, so threads never race to
+    create the same one.
+    """
+    directories = set()
+    for member in members:
+        parent = member.filename if member.is_dir() else posixpath.dirname(member.filename)
+        while parent and parent not in directories:
+            directories.add(parent)
+            parent = posixpath.dirname(parent.rstrip("/"))
+    for directory in sorted(directories):
+        arch.extract(zipfile.ZipInfo(directory.rstrip("/") + "/"), path)
+
+    # Deal out the files largest first, so each thread gets about the same amount to do
+    parts = [[] for _ in range(workers)]
+    files = sorted((m for m in members if not m.is_dir()), key=lambda m: m.file_size, reverse=True)
+    for index, member in enumerate(files):
+        parts[index % workers].append(member)
+
+    def extract_part(part):
+        with zipfile.ZipFile(archive_file) as zip_file:
+            for member in part:
+                zip_file.extract(member, path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(extract_part, part) for part in parts if part]:
+            future.result()
+
+
 def archive(
     files_to_archive,
     name="archive.zip",
@@ -134,6 +358,10 @@ def archive(
     depth=None,
     err_non_exist=True,
     allow_zip_64=True,
+    matcher=None,
+    workers=None,
+    update=False,
+    dedupe=False,
     **tarfile_kwargs,
 ):
     """Archive a list of files (or files inside a folder), can chose between
@@ -149,28 +377,73 @@ def archive(
                               name="my_archive.bz2")
         # 'C:\\Users\\Me\\Reusables\\my_archive.bz2'
 
+    With workers, data is compressed in 1MB blocks on that many threads at
+    once. Deflated zip members are made of raw deflate blocks that end with
+    a sync flush, and gz and bz2 tar files of complete compressed streams
+    one after the other, the same way pigz and pbzip2 work. Both can be
+    read by any unzip, gzip or bzip2 tool, but may be slightly larger.
+
+    Instead of a path, name can be any writable file object, such as a
+    socket or pipe, or a generator that each piece of the archive is sent
+    to. Tar files are then written in stream mode (such as "w|gz") and zip
+    files use data descriptors if the file object cannot seek, so nothing
+    is ever read back or written to disk. archive_type has to be given if
+    it cannot be told from the file object's name.
+
+    ... code:: python
+
+        def upload():
+            with connection() as conn:
+                while True:
+                    conn.send((yield))
+
+        reusables.archive("build", name=upload(), archive_type="gz")
+
+    With update, an existing zip or uncompressed tar file is added to
+    instead of replaced. Only files that are new, or whose size or
+    modification time differ from the stored member, are added. For zip
+    files a member with only a different time is also kept if its CRC
+    still matches, and if any member changed, the zip is rewritten with
+    the unchanged members copied over still compressed. Tar files get
+    changed files appended, the later member wins on extract, as with
+    'tar -u'.
+
+    With dedupe, files with the same content are only stored once in tar
+    files, later copies are added as hardlinks to the first one.
+
+    ... code:: python
+
+        reusables.archive("snapshots", name="snapshots.zip", update=True)
+
     :param files_to_archive: list of files and folders to archive
-    :param name: path and name of archive file
+    :param name: path and name of archive file, or a file object or generator to write it to
     :param archive_type: auto-detects unless specified
     :param overwrite: overwrite if archive exists
     :param store: zipfile only, True will not compress files
     :param depth: specify max depth for folders
     :param err_non_exist: raise error if provided file does not exist
     :param allow_zip_64: must be enabled for zip files larger than 2GB
+    :param matcher: FileMatcher to filter which files inside folders are added
+    :param workers: number of threads to compress with
+    :param update: add new and changed files to an existing zip or tar file
+    :param dedupe: tar only, store files with the same content once
     :param tarfile_kwargs: extra args to pass to tarfile.open
-    :return: path to created archive
+    :return: path to created archive, or name if it is not a path
     """
     if not isinstance(files_to_archive, (list, tuple)):
         files_to_archive = [files_to_archive]
 
+    stream = hasattr(name, "write") or hasattr(name, "send")
     if not archive_type:
-        if name.lower().endswith("zip"):
+        type_name = getattr(name, "name", "") if stream else name
+        type_name = type_name.lower() if isinstance(type_name, str) else ""
+        if type_name.endswith("zip"):
             archive_type = "zip"
-        elif name.lower().endswith("gz"):
+        elif type_name.endswith("gz"):
             archive_type = "gz"
-        elif name.lower().endswith("z2"):
+        elif type_name.endswith("z2"):
             archive_type = "bz2"
-        elif name.lower().endswith("tar"):
+        elif type_name.endswith("tar"):
             archive_type = "tar"
         else:
             err_msg = "Could not determine archive type based off {0}".format(name)
@@ -182,11 +455,22 @@ def archive(
         logger.error(err_msg)
         raise ValueError(err_msg)
 
-    if not overwrite and os.path.exists(name):
+    updating = update and not stream and os.path.exists(name)
+    if update and stream:
+        raise ValueError("update needs the path to an archive, not a file object")
+    if updating and archive_type in ("gz", "bz2"):
+        raise ValueError("Compressed tar files cannot be appended to, only zip and tar files can be updated")
+    if dedupe and archive_type in ("zip", "lzma"):
+        raise ValueError("dedupe is only possible for tar files, zip files cannot link members to each other")
+
+    if not stream and not updating and not overwrite and os.path.exists(name):
         err_msg = "File {0} exists and overwrite not specified".format(name)
         logger.error(err_msg)
         raise OSError(err_msg)
 
+    parallel = workers and workers > 1
+    outfile = (name if hasattr(name, "write") else _SinkWriter(name)) if stream else None
+    compressor = None
     if archive_type in ("zip", "lzma"):
         compression = zipfile.ZIP_DEFLATED
         if archive_type == "lzma":
@@ -194,35 +478,392 @@ def archive(
         elif store:
             compression = zipfile.ZIP_STORED
 
-        arch = zipfile.ZipFile(name, "w", compression, allowZip64=allow_zip_64)
-        write = arch.write
+        if updating:
+            _zip_update(
+                name,
+                _archive_paths(files_to_archive, depth, matcher, err_non_exist),
+                compression,
+                allow_zip_64,
+                workers,
+            )
+            return os.path.abspath(name)
+
+        arch = zipfile.ZipFile(outfile or name, "w", compression, allowZip64=allow_zip_64)
+        write_all = partial(_zip_write, arch, workers=workers, allow_zip_64=allow_zip_64)
     elif archive_type in ("tar", "gz", "bz2"):
         mode = archive_type if archive_type != "tar" else ""
-        arch = tarfile.open(name, "w:{0}".format(mode), **tarfile_kwargs)
-        write = arch.add
+        if updating:
+            arch = tarfile.open(name, "a", **tarfile_kwargs)
+        elif parallel and mode:
+            outfile = outfile or open(name, "wb")
+            compressor = _ParallelCompressor(outfile, archive_type, workers, tarfile_kwargs.pop("compresslevel", 9))
+            arch = tarfile.open(fileobj=compressor, mode="w|", **tarfile_kwargs)
+        elif stream:
+            arch = tarfile.open(fileobj=outfile, mode="w|{0}".format(mode), **tarfile_kwargs)
+        else:
+            arch = tarfile.open(name, "w:{0}".format(mode), **tarfile_kwargs)
+        if updating or dedupe:
+            write_all = partial(_tar_write, arch, update=updating, dedupe=dedupe, workers=workers)
+        else:
+            write_all = partial(_write_each, arch.add)
     else:
         raise ValueError("archive_type must be zip, gz, bz2, lzma, or gz")
 
+    def close():
+        try:
+            arch.close()
+            if compressor:
+                compressor.close()
+        finally:
+            # Only close what was opened here, a given file object is left open
+            if outfile is not None and outfile is not name:
+                outfile.close()
+
     try:
-        for file_path in files_to_archive:
-            if os.path.isfile(file_path):
-                if err_non_exist and not os.path.exists(file_path):
-                    raise OSError("File {0} does not exist".format(file_path))
-                write(file_path)
-            elif os.path.isdir(file_path):
-                for nf in find_files(file_path, abspath=False, depth=depth, disable_pathlib=True):
-                    write(nf)
+        write_all(_archive_paths(files_to_archive, depth, matcher, err_non_exist))
     except (Exception, KeyboardInterrupt) as err:
         logger.exception("Could not archive {0}".format(files_to_archive))
         try:
-            arch.close()
+            close()
         finally:
-            os.unlink(name)
+            if not stream and not updating:
+                os.unlink(name)
         raise err
     else:
-        arch.close()
+        close()
+
+    return name if stream else os.path.abspath(name)
+
+
+class _SinkWriter(object):
+    """File like object that sends everything written to it to a generator, closing it when done"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        if inspect.isgenerator(sink) and inspect.getgeneratorstate(sink) == inspect.GEN_CREATED:
+            next(sink)
+
+    def write(self, data):
+        self.sink.send(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sink.close()
+
+
+_archive_block_size = 1024 * 1024
+_zip_data_descriptor = 0x08074B50
+
+
+def _archive_paths(files_to_archive, depth=None, matcher=None, err_non_exist=True):
+    for file_path in files_to_archive:
+        if os.path.isfile(file_path):
+            if err_non_exist and not os.path.exists(file_path):
+                raise OSError("File {0} does not exist".format(file_path))
+            yield file_path
+        elif os.path.isdir(file_path):
+            for nf in find_files(file_path, abspath=False, depth=depth, disable_pathlib=True, matcher=matcher):
+                yield nf
+
+
+def _write_each(write, paths):
+    for path in paths:
+        write(path)
+
+
+def _zip_write(arch, paths, workers=None, allow_zip_64=True):
+    if workers and workers > 1 and arch.compression == zipfile.ZIP_DEFLATED:
+        _zip_write_parallel(arch, paths, workers=workers, allow_zip_64=allow_zip_64)
+    else:
+        _write_each(arch.write, paths)
+
+
+def _zip_update(name, paths, compression, allow_zip_64=True, workers=None):
+    """
+    Add new and changed files to an existing zip file. New files are simply
+    appended, but if any member changed the zip is written again to a
+    temporary file, copying over every other member without decompressing it.
+    """
+    with zipfile.ZipFile(name) as existing_zip:
+        existing = {info.filename: info for info in existing_zip.infolist()}
+
+    to_add, changed = [], set()
+    for path in paths:
+        info = zipfile.ZipInfo.from_file(path)
+        old = existing.get(info.filename)
+        if old is not None and old.file_size == info.file_size:
+            # Zip files only store times to two seconds
+            same_time = old.date_time[:5] == info.date_time[:5] and old.date_time[5] == info.date_time[5] // 2 * 2
+            if same_time or old.CRC == _crc32_file(path):
+                continue
+        to_add.append(path)
+        if old is not None:
+            changed.add(info.filename)
+    logger.debug("Updating {0} with {1} files, {2} changed".format(name, len(to_add), len(changed)))
+    if not to_add:
+        return
+
+    if not changed:
+        with zipfile.ZipFile(name, "a", compression, allowZip64=allow_zip_64) as arch:
+            _zip_write(arch, to_add, workers=workers, allow_zip_64=allow_zip_64)
+        return
+
+    temp_name = "{0}.{1}.update".format(name, os.getpid())
+    try:
+        with (
+            zipfile.ZipFile(name) as old_zip,
+            zipfile.ZipFile(temp_name, "w", compression, allowZip64=allow_zip_64) as arch,
+        ):
+            for info in old_zip.infolist():
+                if info.filename not in changed:
+                    _zip_copy_raw(old_zip, info, arch)
+            _zip_write(arch, to_add, workers=workers, allow_zip_64=allow_zip_64)
+        os.replace(temp_name, name)
+    finally:
+        if os.path.exists(temp_name):
+            os.unlink(temp_name)
+
+
+def _zip_copy_raw(source_zip, info, arch, block_size=_archive_block_size):
+    """Copy a member from one zip file to another as it is, without decompressing it"""
+    source_zip.fp.seek(info.header_offset)
+    header = source_zip.fp.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    source_zip.fp.seek(info.header_offset + 30 + name_length + extra_length)
+
+    zip64 = max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT
+    info.extra = _strip_zip64_extra(info.extra)
+    # Sizes are known now, so they go in the header instead of a data descriptor
+    info.flag_bits &= ~0x08
+    info.header_offset = arch.fp.tell()
+    arch.fp.write(info.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining:
+        data = source_zip.fp.read(min(block_size, remaining))
+        if not data:
+            raise zipfile.BadZipFile("Member {0} is truncated".format(info.filename))
+        arch.fp.write(data)
+        remaining -= len(data)
+    arch.filelist.append(info)
+    arch.NameToInfo[info.filename] = info
+    arch.start_dir = arch.fp.tell()
+    arch._didModify = True
+
+
+def _strip_zip64_extra(extra):
+    """Remove the zip64 field from a zip extra block, FileHeader adds its own"""
+    kept, offset = b"", 0
+    while offset + 4 <= len(extra):
+        field_id, length = struct.unpack("<HH", extra[offset : offset + 4])
+        if field_id != 0x0001:
+            kept += extra[offset : offset + 4 + length]
+        offset += 4 + length
+    return kept
+
+
+def _crc32_file(path, block_size=_archive_block_size):
+    crc = 0
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, block_size), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def _tar_write(arch, paths, update=False, dedupe=False, workers=None):
+    """
+    Add files to a tar file. With update, files already in it with the same
+    size and modification time are skipped. With dedupe, files with the same
+    content as one already added are stored as hardlinks to it.
+    """
+    existing = {member.name: member for member in arch.getmembers()} if update else {}
+    digests = {}
+    if dedupe:
+        paths = list(paths)
+        digests = _content_keys(paths, workers)
+    stored = {}
+
+    for path in paths:
+        tarinfo = arch.gettarinfo(path)
+        if tarinfo is None:
+            logger.warning("Cannot add {0} to a tar file".format(path))
+            continue
+        old = existing.get(tarinfo.name)
+        if old is not None and old.size == tarinfo.size and int(old.mtime) == int(tarinfo.mtime):
+            continue
+        if not tarinfo.isreg():
+            arch.addfile(tarinfo)
+            continue
+        key = digests.get(path)
+        if key in stored:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = stored[key]
+            tarinfo.size = 0
+            arch.addfile(tarinfo)
+            continue
+        with open(path, "rb") as f:
+            arch.addfile(tarinfo, f)
+        if key:
+            stored[key] = tarinfo.name
+
+
+def _content_keys(paths, workers=None):
+    """(size, sha256) of each file that is the same size as another, to tell which are identical"""
+    size_map = defaultdict(list)
+    for path in paths:
+        try:
+            size_map[os.path.getsize(path)].append(path)
+        except OSError:
+            continue
+    candidates = {path: size for size, group in size_map.items() if len(group) > 1 for path in group}
+    return {
+        path: (candidates[path], digest)
+        for path, digest in hash_files(candidates, "sha256", workers=workers, ignore_errors=True)
+        if digest
+    }
+
+
+def _ordered_imap(func, items, workers):
+    """
+    Yield (item, func(item)) tuples in the same order as items, from a thread
+    pool. Like _pool_imap only a few items per worker are in flight at once.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) > workers * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def _deflate_block(block, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Raw deflate a (data, last) block, only the last block of a file finishes the stream"""
+    data, last = block
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _zip_write_parallel(arch, paths, workers=4, allow_zip_64=True, block_size=_archive_block_size):
+    """
+    Deflate the files in blocks on a thread pool (zlib releases the GIL) and
+    write them into the zip file in order as raw, already compressed entries.
+    The local header is written first with the sizes known from stat, then
+    rewritten with the CRC and compressed size once the file is done, or
+    if the zip file cannot seek, followed by a data descriptor instead.
+    """
+
+    def blocks():
+        for path in paths:
+            zinfo = zipfile.ZipInfo.from_file(path)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as infile:
+                data = infile.read(block_size)
+                first = True
+                while True:
+                    next_data = infile.read(block_size)
+                    yield zinfo, first, data, not next_data
+                    if not next_data:
+                        break
+                    first, data = False, next_data
+
+    seekable = getattr(arch, "_seekable", True)
+    zip64 = False
+    for (zinfo, first, data, last), compressed in _ordered_imap(
+        lambda block: _deflate_block(block[2:]), blocks(), workers
+    ):
+        if first:
+            zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+            if zip64 and not allow_zip_64:
+                raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+            zinfo.header_offset = arch.fp.tell()
+            zinfo.CRC, zinfo.compress_size, zinfo.file_size = 0, 0, 0
+            if not seekable:
+                # Sizes and CRC follow the data, as it cannot be gone back to
+                zinfo.flag_bits |= 0x08
+            arch.fp.write(zinfo.FileHeader(zip64))
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC)
+        zinfo.compress_size += len(compressed)
+        zinfo.file_size += len(data)
+        arch.fp.write(compressed)
+        if last:
+            if not zip64 and max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+                raise RuntimeError("File size too large, try using force_zip64")
+            if seekable:
+                end = arch.fp.tell()
+                arch.fp.seek(zinfo.header_offset)
+                arch.fp.write(zinfo.FileHeader(zip64))
+                arch.fp.seek(end)
+            else:
+                arch.fp.write(
+                    struct.pack(
+                        "<LLQQ" if zip64 else "<LLLL",
+                        _zip_data_descriptor,
+                        zinfo.CRC,
+                        zinfo.compress_size,
+                        zinfo.file_size,
+                    )
+                )
+                end = arch.fp.tell()
+            arch.filelist.append(zinfo)
+            arch.NameToInfo[zinfo.filename] = zinfo
+            arch.start_dir = end
+            # Like ZipFile.write, so close() writes the central directory, needed in append mode
+            arch._didModify = True
+
+
+class _ParallelCompressor(object):
+    """
+    Write only file object that gzip or bzip2 compresses each block of data
+    written to it as its own complete stream on a thread pool, and writes
+    them to fileobj in order. Closing it leaves fileobj open.
+    """
+
+    def __init__(self, fileobj, compression="gz", workers=4, level=9, block_size=_archive_block_size):
+        self.fileobj = fileobj
+        self.workers = workers
+        self.block_size = block_size
+        if compression == "gz":
+            self.compress = partial(_gzip_block, level=level)
+        else:
+            import bz2
+
+            self.compress = partial(bz2.compress, compresslevel=level)
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(self.compress, block))
+        while len(self._pending) > self.workers * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
 
-    return os.path.abspath(name)
+def _gzip_block(data, level=9):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
 
 
 def list_to_csv(my_list, csv_file):
@@ -400,7 +1041,7 @@ def config_namespace(config_file=None, auto_find=False, verify=True, **cfg_optio
     return ConfigNamespace(**config_dict(config_file, auto_find, verify, **cfg_options))
 
 
-def os_tree(directory, enable_scandir=False):
+def os_tree(directory, enable_scandir=False, files=False, max_depth=None):
     """
     Return a directories contents as a dictionary hierarchy.
 
@@ -413,8 +1054,11 @@ def os_tree(directory, enable_scandir=False):
         #  'reusables': {'__pycache__': {}},
         #  'test': {'__pycache__': {}, 'data': {}}}
 
+    For a tree that is only listed as it is used, see DirectoryTree.
 
     :param directory: path to directory to created the tree of.
+    :param files: include files, as FileEntry values
+    :param max_depth: how many levels of directories below directory to list
     :return: dictionary of the directory
     """
     if enable_scandir and not scandir_warning_given:
@@ -425,52 +1069,594 @@ def os_tree(directory, enable_scandir=False):
     if not os.path.isdir(directory):
         raise OSError("Path is not a directory")
 
-    full_list = []
-    for root, dirs, files in os.walk(directory):
-        full_list.extend([os.path.join(root, d).lstrip(directory) + os.sep for d in dirs])
-    tree = {os.path.basename(directory): {}}
-    for item in full_list:
-        separated = item.split(os.sep)
-        is_dir = separated[-1:] == [""]
-        if is_dir:
-            separated = separated[:-1]
-        parent = tree[os.path.basename(directory)]
-        for index, path in enumerate(separated):
-            if path in parent:
-                parent = parent[path]
+    return {os.path.basename(directory): DirectoryTree(directory, files=files, max_depth=max_depth).to_dict()}
+
+
+class DirectoryTree(object):
+    """
+    Lazy directory hierarchy. A directory is only listed, with a single
+    os.scandir call, the first time its children are accessed. Children
+    are DirectoryTree objects for sub directories and, if files is set,
+    FileEntry records carrying the size and modification time of files.
+    Symlinked directories are not followed.
+
+    ... code:: python
+
+        tree = reusables.DirectoryTree("Pictures", files=True, max_depth=2)
+        for name, child in tree.items():
+            print(name, child.size if isinstance(child, reusables.FileEntry) else "<dir>")
+
+        tree["2016"].to_dict()
+        # {'holiday': {}, 'IMG_20161127.jpg': FileEntry(...)}
+
+        for path, size in tree.sizes():
+            print(path, size)
+
+    :param path: directory at the root of the tree
+    :param files: include files as well as directories
+    :param max_depth: how many levels of directories below path to list
+    :param depth: how deep this directory is in the tree
+    """
+
+    def __init__(self, path, files=False, max_depth=None, depth=0):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.files = files
+        self.max_depth = max_depth
+        self.depth = depth
+        self._children = None
+
+    def __repr__(self):
+        return "<DirectoryTree {0}>".format(self.path)
+
+    @property
+    def children(self):
+        """Dictionary of names to DirectoryTree and FileEntry, listed on first access"""
+        if self._children is None:
+            self._children = {}
+            if self.max_depth is None or self.depth < self.max_depth:
+                _, file_entries, sub_directories = _list_directory(self.path, 0)
+                for sub_directory in sub_directories:
+                    child = DirectoryTree(sub_directory, self.files, self.max_depth, self.depth + 1)
+                    self._children[child.name] = child
+                if self.files:
+                    for file_entry in filter(None, map(_file_entry, file_entries)):
+                        self._children[file_entry.name] = file_entry
+        return self._children
+
+    def __getitem__(self, name):
+        return self.children[name]
+
+    def __contains__(self, name):
+        return name in self.children
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def items(self):
+        return self.children.items()
+
+    def to_dict(self):
+        """
+        Fully list the tree into nested dictionaries, with FileEntry
+        values for files.
+
+        :return: dictionary of the directory
+        """
+        return {name: child.to_dict() if isinstance(child, DirectoryTree) else child for name, child in self.items()}
+
+    def sizes(self):
+        """
+        Cumulative size of each directory in the tree, see directory_sizes.
+
+        :return: generator of (path, size) tuples, deepest directories first
+        """
+        return directory_sizes(self.path, max_depth=self.max_depth)
+
+
+def directory_sizes(directory, max_depth=None):
+    """
+    Generator of the total size of each directory, including everything
+    below it, similar to the 'du' command. Every directory is listed once
+    and sizes are added up bottom up, so each directory is yielded as soon
+    as everything below it has been counted. Sizes are apparent sizes
+    (st_size), and files with multiple hardlinks are only counted once.
+
+    ... code:: python
+
+        for path, size in reusables.directory_sizes("Pictures", max_depth=1):
+            print(path, size)
+        # Pictures/2016 4201844
+        # Pictures/2017 2093817
+        # Pictures 6295661
+
+    :param directory: directory to start at, it is yielded last
+    :param max_depth: only yield directories this many levels below directory,
+        deeper directories are still counted in their parents
+    :return: generator of (path, size) tuples
+    """
+    seen_inodes = set()
+
+    def listing(path, depth):
+        _, file_entries, sub_directories = _list_directory(path, 0)
+        total = 0
+        for entry in file_entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
                 continue
-            else:
-                parent[path] = dict()
-            parent = parent[path]
-    return tree
+            if stat.st_nlink > 1:
+                if (stat.st_dev, stat.st_ino) in seen_inodes:
+                    continue
+                seen_inodes.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+        return [path, depth, total, sub_directories]
+
+    stack = [listing(directory, 0)]
+    while stack:
+        path, depth, total, sub_directories = stack[-1]
+        if sub_directories:
+            stack.append(listing(sub_directories.pop(), depth + 1))
+            continue
+        stack.pop()
+        if stack:
+            stack[-1][2] += total
+        if max_depth is None or depth <= max_depth:
+            yield path, total
+
+
+class HashCache(object):
+    """
+    Persistent file hash cache stored in a sqlite database. Hashes are saved
+    per hash type and keyed on the device and inode of the file, and are only
+    returned while the file's size and modification time (in nanoseconds)
+    are still the same as when it was hashed. Unchanged files therefore only
+    cost a stat call on later runs.
+
+    The database is opened in WAL mode with a connection per thread, so it
+    can be shared by threads and read by multiple processes at the same time.
+
+    ... code:: python
+
+        cache = reusables.HashCache("hashes.sqlite")
+        reusables.file_hash("big_video.mkv", hash_cache=cache)  # Reads the file
+        reusables.file_hash("big_video.mkv", hash_cache=cache)  # Only stats it
+
+        reusables.directory_duplicates("Videos", hash_cache=cache)
+
+    :param database: path to the sqlite database file, created if missing
+    :param timeout: seconds to wait for a locked database
+    """
+
+    def __init__(self, database, timeout=30):
+        self.database = database
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection()
+
+    def __repr__(self):
+        return "<HashCache {0}>".format(self.database)
+
+    def __getstate__(self):
+        return {"database": self.database, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes ("
+                "device INTEGER, inode INTEGER, hash_type TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, "
+                "PRIMARY KEY (device, inode, hash_type))"
+            )
+            self._local.connection = connection
+        return connection
+
+    def get(self, stat, hash_type="md5"):
+        """
+        Look up the hex digest of a file, if it has not changed since it was stored.
+
+        :param stat: os.stat_result (or FileEntry) of the file
+        :param hash_type: string name of the hash
+        :return: hex digest or None
+        """
+        device, inode, size, mtime_ns = _stat_key(stat)
+        row = (
+            self._connection()
+            .execute(
+                "SELECT digest FROM file_hashes WHERE device=? AND inode=? AND hash_type=? AND size=? AND mtime_ns=?",
+                (device, inode, hash_type, size, mtime_ns),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def set(self, stat, digest, hash_type="md5"):
+        """
+        Save the hex digest of a file, replacing any older hash of it.
+
+        :param stat: os.stat_result (or FileEntry) of the file when it was hashed
+        :param digest: hex digest of the file
+        :param hash_type: string name of the hash
+        """
+        device, inode, size, mtime_ns = _stat_key(stat)
+        self._connection().execute(
+            "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+            (device, inode, hash_type, size, mtime_ns, digest),
+        )
+
+    def close(self):
+        """Close this thread's connection to the database"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
 
 
-def file_hash(path, hash_type="md5", block_size=65536, hex_digest=True):
+def _stat_key(stat):
+    if isinstance(stat, FileEntry):
+        device, inode, size, mtime_ns = stat.device, stat.inode, stat.size, stat.mtime_ns
+    else:
+        device, inode, size, mtime_ns = stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+    # sqlite integers are signed 64 bit, large device and file ids wrap around
+    if device >= 1 << 63:
+        device -= 1 << 64
+    if inode >= 1 << 63:
+        inode -= 1 << 64
+    return device, inode, size, mtime_ns
+
+
+def file_hash(path, hash_type="md5", block_size=None, hex_digest=True, hash_cache=None, buffer=None, mode="auto"):
     """
     Hash a given file with md5, or any other and return the hex digest. You
     can run `hashlib.algorithms_available` to see which are available on your
     system unless you have an archaic python version, you poor soul).
 
-    This function is designed to be non memory intensive.
+    This function is designed to be non memory intensive. Files are either
+    read into a single reusable buffer ("readinto" mode, the buffer can also
+    be provided to share it between calls), or memory mapped and handed to
+    the hashers without copying ("mmap" mode). The default "auto" mode uses
+    mmap for files of 64 MiB or larger.
+
+    Unless specified, block_size is picked from the file system's preferred
+    block size (st_blksize), but never smaller than 64 KiB.
+
+    Provide a list of hash types to have the file read only once and every
+    hash calculated in the same pass, a dictionary of them is returned.
 
     ... code:: python
 
         reusables.file_hash(test_structure.zip")
         # '61e387de305201a2c915a4f4277d6663'
 
+        reusables.file_hash("test_structure.zip", hash_type=["md5", "sha256"])
+        # {'md5': '61e387de305201a2c915a4f4277d6663',
+        #  'sha256': 'bc11af55928ab89771b9a141fa526a5b8a3dbc7d6870fece9b91af5d345a75ea'}
+
     :param path: location of the file to hash
-    :param hash_type: string name of the hash to use
+    :param hash_type: string name of the hash to use, or a list of them
     :param block_size: amount of bytes to add to hasher at a time
     :param hex_digest: returned as hexdigest, false will return digest
-    :return: file's hash
+    :param hash_cache: HashCache to look up and store the hash in
+    :param buffer: bytearray to read the file into, overrides block_size
+    :param mode: "auto", "mmap" or "readinto"
+    :return: file's hash, or dictionary of hashes if hash_type was a list
+    """
+    if mode not in ("auto", "mmap", "readinto"):
+        raise ValueError('mode must be "auto", "mmap" or "readinto", was {0}'.format(mode))
+    hash_types = [hash_type] if isinstance(hash_type, str) else list(hash_type)
+    hashers = {name: hashlib.new(name) for name in hash_types}
+
+    results = {}
+    if hash_cache is not None:
+        stat = os.stat(path)
+        for name in hash_types:
+            cached = hash_cache.get(stat, name)
+            if cached:
+                results[name] = cached if hex_digest else bytes.fromhex(cached)
+                del hashers[name]
+
+    if hashers:
+        updates = [hashed.update for hashed in hashers.values()]
+        with open(path, "rb", buffering=0) as infile:
+            file_stat = os.fstat(infile.fileno())
+            if not block_size:
+                block_size = _block_size(file_stat)
+            use_mmap = mode == "mmap" or (mode == "auto" and file_stat.st_size >= _mmap_threshold)
+            if use_mmap and file_stat.st_size and buffer is None:
+                _hash_mmap(infile, updates, max(block_size, _mmap_block_size))
+            else:
+                _hash_readinto(infile, updates, buffer if buffer is not None else bytearray(block_size))
+        for name, hashed in hashers.items():
+            if hash_cache is not None:
+                hash_cache.set(stat, hashed.hexdigest(), name)
+            results[name] = hashed.hexdigest() if hex_digest else hashed.digest()
+
+    return results[hash_type] if isinstance(hash_type, str) else results
+
+
+_mmap_threshold = 64 * 1024 * 1024
+_mmap_block_size = 4 * 1024 * 1024
+
+
+def _block_size(stat):
+    """Preferred read size, a multiple of the file system block size of at least 64 KiB"""
+    preferred = getattr(stat, "st_blksize", 0) or 4096
+    return -(-65536 // preferred) * preferred
+
+
+def _hash_readinto(infile, updates, buffer):
+    with memoryview(buffer) as view:
+        size = infile.readinto(view)
+        while size:
+            with view[:size] as block:
+                for update in updates:
+                    update(block)
+            size = infile.readinto(view)
+
+
+def _hash_mmap(infile, updates, block_size):
+    with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        for start in range(0, len(view), block_size):
+            with view[start : start + block_size] as block:
+                for update in updates:
+                    update(block)
+
+
+TreeHash = namedtuple("TreeHash", ["root", "chunks", "chunk_size", "size"])
+TreeHash.__doc__ = """Result of file_hash_tree, the root hash and the hash of every chunk of the file"""
+
+
+def file_hash_tree(path, hash_type="sha256", chunk_size=64 * 1024 * 1024, workers=4, block_size=None):
+    """
+    Hash a file as a set of fixed size chunks in parallel, so very large
+    files are not limited to a single core. Each chunk is read with os.pread
+    into its own buffer, and the root hash is the hash of all the chunk
+    digests in order. The root is deterministic for the same content,
+    hash_type and chunk_size, but is not the same as the file_hash of the file.
+
+    The chunk hashes can be compared against another copy of the file to
+    find which parts of it changed.
+
+    ... code:: python
+
+        tree = reusables.file_hash_tree("disk_image.vmdk", workers=8)
+        tree.root
+        # '7d3f5e...'
+        len(tree.chunks)
+        # 1600
+
+    :param path: location of the file to hash
+    :param hash_type: string name of the hash to use
+    :param chunk_size: size of each independently hashed chunk
+    :param workers: number of chunks to hash at once
+    :param block_size: amount of bytes to read at a time inside a chunk
+    :return: TreeHash of the root hex digest, list of chunk hex digests, chunk size and file size
     """
+    hashlib.new(hash_type)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive number of bytes")
+
+    with open(path, "rb", buffering=0) as infile:
+        file_stat = os.fstat(infile.fileno())
+        block_size = min(block_size or _block_size(file_stat), chunk_size)
+        hasher = partial(_hash_range, infile, hash_type=hash_type, chunk_size=chunk_size, block_size=block_size)
+        offsets = range(0, file_stat.st_size, chunk_size)
+        digests = dict(_pool_imap(hasher, offsets, workers, "thread"))
+
+    chunks = [digests[offset] for offset in offsets]
+    root = hashlib.new(hash_type)
+    for chunk in chunks:
+        root.update(bytes.fromhex(chunk))
+    return TreeHash(root.hexdigest(), chunks, chunk_size, file_stat.st_size)
+
+
+def _hash_range(infile, offset, hash_type="sha256", chunk_size=65536, block_size=65536):
+    """Hash chunk_size bytes of an open file from offset, without moving its position"""
     hashed = hashlib.new(hash_type)
-    with open(path, "rb") as infile:
-        buf = infile.read(block_size)
-        while len(buf) > 0:
-            hashed.update(buf)
-            buf = infile.read(block_size)
-    return hashed.hexdigest() if hex_digest else hashed.digest()
+    buffer = bytearray(block_size)
+    end = offset + chunk_size
+    with memoryview(buffer) as view:
+        while offset < end:
+            size = _pread_into(infile, view[: min(block_size, end - offset)], offset)
+            if not size:
+                break
+            with view[:size] as block:
+                hashed.update(block)
+            offset += size
+    return hashed.hexdigest()
+
+
+if hasattr(os, "preadv"):
+
+    def _pread_into(infile, view, offset):
+        return os.preadv(infile.fileno(), [view], offset)
+
+elif hasattr(os, "pread"):
+
+    def _pread_into(infile, view, offset):
+        data = os.pread(infile.fileno(), len(view), offset)
+        view[: len(data)] = data
+        return len(data)
+
+else:
+    _pread_lock = threading.Lock()
+
+    def _pread_into(infile, view, offset):
+        with _pread_lock:
+            infile.seek(offset)
+            return infile.readinto(view)
+
+
+def hash_files(
+    paths, hash_type="md5", workers=4, executor="thread", ignore_errors=False, hash_cache=None, **hash_kwargs
+):
+    """
+    Hash many files at the same time, yields a tuple of the path and its
+    hash as each one finishes (not in the order they were provided).
+
+    hashlib releases the GIL while hashing, so a thread pool is usually
+    enough to keep fast disks busy, a process pool can also be used. Paths
+    may be any iterable (such as a generator), only a few per worker are
+    submitted at a time.
+
+    ... code:: python
+
+        for path, digest in reusables.hash_files(reusables.find_files("Videos"), workers=8):
+            print(path, digest)
+
+    :param paths: iterable of files to hash
+    :param hash_type: string name of the hash to use, or a list of them
+    :param workers: number of files to hash at once
+    :param executor: "thread" or "process" pool for the workers
+    :param ignore_errors: log and skip files that could not be read instead of raising
+    :param hash_cache: HashCache to look up and store the hashes in
+    :param hash_kwargs: additional arguments to pass to file_hash
+    :return: generator of (path, hash) tuples
+    """
+    hasher = partial(
+        _try_file_hash if ignore_errors else file_hash, hash_type=hash_type, hash_cache=hash_cache, **hash_kwargs
+    )
+    for path, digest in _pool_imap(hasher, paths, workers, executor):
+        if digest is None:
+            logger.warning("Could not hash {0}".format(path))
+            continue
+        yield path, digest
+
+
+def _try_file_hash(path, **kwargs):
+    try:
+        return file_hash(path, **kwargs)
+    except OSError:
+        return None
+
+
+def _pool_imap(func, items, workers=None, executor="thread"):
+    """
+    Yield (item, func(item)) tuples as they finish, from a thread or process
+    pool if there are workers. Items are consumed lazily, keeping only a few
+    per worker in flight.
+    """
+    if not workers or workers < 2:
+        for item in items:
+            yield item, func(item)
+        return
+
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers)
+    elif executor == "process":
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError('executor must be "thread" or "process", was {0}'.format(executor))
+
+    items = iter(items)
+    try:
+        pending = {pool.submit(func, item): item for item in islice(items, workers * 4)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                for next_item in islice(items, 1):
+                    pending[pool.submit(func, next_item)] = next_item
+                yield item, future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class FileMatcher(object):
+    """
+    Precompiled file name filter, built once and then used to check each file
+    name found by find_files, scan_files, count_files or archive. Extensions
+    are checked with a single endswith call, and glob names are translated
+    to a regular expression instead of listing every directory again.
+
+    A name with glob magic characters is used as a glob, otherwise it only
+    needs to be part of the file name. Like glob, wildcards will not match
+    hidden (dot) files unless the pattern itself starts with a dot.
+
+    ... code:: python
+
+        matcher = reusables.FileMatcher(ext=[".jpg", ".png"], name="holiday")
+        matcher.match("Holiday_2016.JPG")
+        # True
+
+        reusables.find_files_list("Pictures", matcher=matcher)
+
+    :param ext: Extensions of the file you are looking for
+    :param name: Part of the file name, or a glob pattern
+    :param match_case: If name or ext has to be a direct match or not
+    :param disable_glob: Do not look for globable names or use glob magic check
+    :param regex: regular expression (string or compiled) to search file names with
+    """
+
+    def __init__(self, ext=None, name=None, match_case=False, disable_glob=False, regex=None):
+        if ext and isinstance(ext, str):
+            ext = [ext]
+        elif ext and not isinstance(ext, (list, tuple)):
+            raise TypeError("extension must be either one extension or a list")
+
+        if ext or not name:
+            disable_glob = True
+        if not disable_glob:
+            disable_glob = not glob.has_magic(name)
+        if not disable_glob and match_case:
+            raise ValueError("Cannot use glob and match case, please either disable glob or not set match_case")
+
+        self.match_case = match_case
+        self.extensions = tuple(end if match_case else end.lower() for end in ext) if ext else None
+        self.name = None
+        self.glob = None
+        self.hidden = True
+        if name and disable_glob:
+            self.name = name if match_case else name.lower()
+        elif name:
+            self.glob = re.compile(fnmatch.translate(name), re.IGNORECASE if win_based else 0)
+            self.hidden = name.startswith(".")
+        self.regex = re.compile(regex) if isinstance(regex, str) else regex
+
+    def __repr__(self):
+        return "<FileMatcher ext={0} name={1} glob={2} regex={3}>".format(
+            self.extensions, self.name, self.glob.pattern if self.glob else None, self.regex
+        )
+
+    def __call__(self, file_name):
+        return self.match(file_name)
+
+    def match(self, file_name):
+        """
+        Check if a file name (not a full path) passes all filters.
+
+        :param file_name: name of the file
+        :return: boolean if the file is a match
+        """
+        if self.extensions or self.name:
+            compare_name = file_name if self.match_case else file_name.lower()
+            if self.extensions and not compare_name.endswith(self.extensions):
+                return False
+            if self.name and self.name not in compare_name:
+                return False
+        if self.glob:
+            if not self.hidden and file_name.startswith("."):
+                return False
+            if not self.glob.match(file_name):
+                return False
+        if self.regex and not self.regex.search(file_name):
+            return False
+        return True
 
 
 def find_files_list(*args, **kwargs):
@@ -480,6 +1666,7 @@ def find_files_list(*args, **kwargs):
 
 def count_files(*args, **kwargs):
     """Returns an integer of all files found using find_files"""
+    kwargs.setdefault("ordered", False)
     return sum(1 for _ in find_files(*args, **kwargs))
 
 
@@ -493,6 +1680,11 @@ def find_files(
     abspath=False,
     enable_scandir=False,
     disable_pathlib=False,
+    workers=None,
+    ordered=True,
+    exclude=None,
+    exclude_dirs=None,
+    matcher=None,
 ):
     """
     Walk through a file directory and return an iterator of files
@@ -505,6 +1697,18 @@ def find_files(
     Note: For the example below, you can use find_files_list to return as a
     list, this is simply an easy way to show the output.
 
+    On high latency (network) file systems, set workers to list multiple
+    directories at the same time. Results are still streamed back as they
+    are found, set ordered to False to get them as soon as any directory
+    has been listed instead of in walk order.
+
+    Directories below depth or matching exclude_dirs are pruned before they
+    are listed, so skipped sub trees cost nothing to search.
+
+    ... code:: python
+
+        list(reusables.find_files(ext=".py", exclude_dirs=[".git", "node_modules", "__pycache__"]))
+
     ... code:: python
 
         list(reusables.find_files(name="ex", match_case=True))
@@ -531,54 +1735,229 @@ def find_files(
     :param depth: How many directories down to search
     :param abspath: Return files with their absolute paths
     :param disable_pathlib: only return string, not path objects
+    :param workers: number of threads to list directories with in parallel
+    :param ordered: with workers, keep the same order as a single threaded walk
+    :param exclude: glob pattern(s) of file names to skip
+    :param exclude_dirs: glob pattern(s) of directory names to never walk into
+    :param matcher: FileMatcher to use instead of ext, name, match_case and disable_glob
     :return: generator of all files in the specified directory
     """
     if enable_scandir and not scandir_warning_given:
         scandir_warning()
 
-    def pathed(path):
-        if disable_pathlib:
-            return path
-        return Path(path)
-
-    if ext or not name:
-        disable_glob = True
-    if not disable_glob:
-        disable_glob = not glob.has_magic(name)
+    for entry in _find_entries(
+        directory,
+        ext=ext,
+        name=name,
+        match_case=match_case,
+        disable_glob=disable_glob,
+        depth=depth,
+        abspath=abspath,
+        workers=workers,
+        ordered=ordered,
+        exclude=exclude,
+        exclude_dirs=exclude_dirs,
+        matcher=matcher,
+    ):
+        yield entry.path if disable_pathlib else Path(entry.path)
+
+
+def scan_files(
+    directory=".",
+    ext=None,
+    name=None,
+    match_case=False,
+    disable_glob=False,
+    depth=None,
+    abspath=False,
+    workers=None,
+    ordered=True,
+    exclude=None,
+    exclude_dirs=None,
+    matcher=None,
+):
+    """
+    Same search as find_files, but yields FileEntry records that carry the
+    size, modification time (in nanoseconds), inode and device of each file.
+    Each file is stat-ed exactly once while walking, so callers never have to
+    call os.path.getsize or os.stat on the results again.
 
-    if ext and isinstance(ext, str):
-        ext = [ext]
-    elif ext and not isinstance(ext, (list, tuple)):
-        raise TypeError("extension must be either one extension or a list")
-    if abspath:
-        directory = os.path.abspath(directory)
-    starting_depth = directory.count(os.sep)
+    Files that can not be stat-ed (such as broken symlinks) are skipped.
 
-    for root, dirs, files in os.walk(directory):
-        if depth and root.count(os.sep) - starting_depth >= depth:
-            continue
+    ... code:: python
 
-        if not disable_glob:
-            if match_case:
-                raise ValueError("Cannot use glob and match case, please either disable glob or not set match_case")
-            glob_generator = glob.iglob(os.path.join(root, name))
-            for item in glob_generator:
-                yield pathed(item)
-            continue
+        for entry in reusables.scan_files(ext=".pdf"):
+            print(entry.path, entry.size)
+        # C:\\Example.pdf 10353
+        # C:\\how_to_program.pdf 204800
 
-        for file_name in files:
-            if ext:
-                for end in ext:
-                    if file_name.lower().endswith(end.lower() if not match_case else end):
-                        break
-                else:
-                    continue
-            if name:
-                if match_case and name not in file_name:
-                    continue
-                elif name.lower() not in file_name.lower():
-                    continue
-            yield pathed(os.path.join(root, file_name))
+    :param directory: Top location to recursively search for matching files
+    :param ext: Extensions of the file you are looking for
+    :param name: Part of the file name
+    :param match_case: If name or ext has to be a direct match or not
+    :param disable_glob: Do not look for globable names or use glob magic check
+    :param depth: How many directories down to search
+    :param abspath: Return files with their absolute paths
+    :param workers: number of threads to list directories with in parallel
+    :param ordered: with workers, keep the same order as a single threaded walk
+    :param exclude: glob pattern(s) of file names to skip
+    :param exclude_dirs: glob pattern(s) of directory names to never walk into
+    :param matcher: FileMatcher to use instead of ext, name, match_case and disable_glob
+    :return: generator of FileEntry
+    """
+    for entry in _find_entries(
+        directory,
+        ext=ext,
+        name=name,
+        match_case=match_case,
+        disable_glob=disable_glob,
+        depth=depth,
+        abspath=abspath,
+        workers=workers,
+        ordered=ordered,
+        exclude=exclude,
+        exclude_dirs=exclude_dirs,
+        matcher=matcher,
+    ):
+        file_entry = _file_entry(entry)
+        if file_entry:
+            yield file_entry
+
+
+def _file_entry(dir_entry):
+    try:
+        stat = dir_entry.stat()
+    except OSError:
+        logger.debug("Could not stat {0}".format(dir_entry.path))
+        return None
+    return FileEntry(dir_entry.path, dir_entry.name, stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def _compile_globs(patterns):
+    """Combine one or more glob patterns into a single compiled regex"""
+    if not patterns:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE if win_based else 0)
+
+
+def _list_directory(root, level, depth=None, exclude_dirs=None):
+    """
+    List a single directory with os.scandir, returns a tuple of the directory
+    path, the os.DirEntry objects for the files in it, and the sub directories
+    that should still be walked (symlinked directories are not followed, just
+    like os.walk, and nothing deeper than depth or matching the exclude_dirs
+    regex is returned).
+    """
+    try:
+        with os.scandir(root) as scanner:
+            entries = list(scanner)
+    except OSError as err:
+        logger.debug("Could not list {0} - {1}".format(root, err))
+        return root, [], []
+    files, sub_directories = [], []
+    walk_deeper = not depth or level + 1 < depth
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            files.append(entry)
+        elif walk_deeper and not entry.is_symlink():
+            if exclude_dirs and exclude_dirs.match(entry.name):
+                continue
+            sub_directories.append(entry.path)
+    return root, files, sub_directories
+
+
+def _walk_files(directory, depth=None, workers=None, ordered=True, exclude_dirs=None):
+    """
+    Top down walk of a directory, yields a tuple of the directory path and a
+    list of the os.DirEntry objects for the files in it.
+
+    With workers, directories are listed in a thread pool. When ordered,
+    results come back in the same order as the single threaded walk,
+    otherwise each directory is returned as soon as it has been listed.
+    """
+    list_directory = partial(_list_directory, depth=depth, exclude_dirs=exclude_dirs)
+
+    if workers and workers > 1:
+        walker = _walk_files_ordered if ordered else _walk_files_unordered
+        for result in walker(directory, list_directory, workers):
+            yield result
+        return
+
+    stack = [(directory, 0)]
+    while stack:
+        root, level = stack.pop()
+        root, files, sub_directories = list_directory(root, level)
+        yield root, files
+        stack.extend((sub_directory, level + 1) for sub_directory in reversed(sub_directories))
+
+
+def _walk_files_ordered(directory, list_directory, workers):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # Every child is submitted as soon as its parent is listed, so
+        # siblings are being listed while the first subtree is consumed
+        stack = [(executor.submit(list_directory, directory, 0), 0)]
+        while stack:
+            future, level = stack.pop()
+            root, files, sub_directories = future.result()
+            yield root, files
+            children = [
+                (executor.submit(list_directory, sub_directory, level + 1), level + 1)
+                for sub_directory in sub_directories
+            ]
+            stack.extend(reversed(children))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _walk_files_unordered(directory, list_directory, workers):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {executor.submit(list_directory, directory, 0): 0}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                level = pending.pop(future)
+                root, files, sub_directories = future.result()
+                for sub_directory in sub_directories:
+                    pending[executor.submit(list_directory, sub_directory, level + 1)] = level + 1
+                yield root, files
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _find_entries(
+    directory,
+    ext=None,
+    name=None,
+    match_case=False,
+    disable_glob=False,
+    depth=None,
+    abspath=False,
+    workers=None,
+    ordered=True,
+    exclude=None,
+    exclude_dirs=None,
+    matcher=None,
+):
+    if matcher is None:
+        matcher = FileMatcher(ext=ext, name=name, match_case=match_case, disable_glob=disable_glob)
+    if abspath:
+        directory = os.path.abspath(directory)
+    exclude = _compile_globs(exclude)
+
+    for root, files in _walk_files(directory, depth, workers, ordered, _compile_globs(exclude_dirs)):
+        for entry in files:
+            if exclude and exclude.match(entry.name):
+                continue
+            if matcher.match(entry.name):
+                yield entry
 
 
 def remove_empty_directories(root_directory, dry_run=False, ignore_errors=True, enable_scandir=False):
@@ -593,32 +1972,7 @@ def remove_empty_directories(root_directory, dry_run=False, ignore_errors=True,
     if enable_scandir and not scandir_warning_given:
         scandir_warning()
 
-    directory_list = []
-    for root, directories, files in os.walk(root_directory, topdown=False):
-        if not directories and not files and os.path.exists(root) and root != root_directory and os.path.isdir(root):
-            directory_list.append(root)
-            if not dry_run:
-                try:
-                    os.rmdir(root)
-                except OSError as err:
-                    if ignore_errors:
-                        logger.info("{0} could not be deleted".format(root))
-                    else:
-                        raise err
-        elif directories and not files:
-            for directory in directories:
-                directory = join_paths(root, directory, strict=True)
-                if os.path.exists(directory) and os.path.isdir(directory) and not os.listdir(directory):
-                    directory_list.append(directory)
-                    if not dry_run:
-                        try:
-                            os.rmdir(directory)
-                        except OSError as err:
-                            if ignore_errors:
-                                logger.info("{0} could not be deleted".format(directory))
-                            else:
-                                raise err
-    return directory_list
+    return list(remove_empty(root_directory, files=False, dry_run=dry_run, ignore_errors=ignore_errors))
 
 
 def remove_empty_files(root_directory, dry_run=False, ignore_errors=True, enable_scandir=False):
@@ -633,30 +1987,90 @@ def remove_empty_files(root_directory, dry_run=False, ignore_errors=True, enable
     if enable_scandir and not scandir_warning_given:
         scandir_warning()
 
-    file_list = []
-    for root, directories, files in os.walk(root_directory):
-        for file_name in files:
-            file_path = join_paths(root, file_name, strict=True)
-            if os.path.isfile(file_path) and not os.path.getsize(file_path):
-                if file_hash(file_path) == variables.hashes.empty_file.md5:
-                    file_list.append(file_path)
+    removed = remove_empty(root_directory, directories=False, dry_run=dry_run, ignore_errors=ignore_errors)
+    return sorted(os.path.abspath(path) for path in removed)
 
-    file_list = sorted(set(file_list))
 
-    if not dry_run:
-        for afile in file_list:
-            try:
-                os.unlink(afile)
-            except OSError as err:
-                if ignore_errors:
-                    logger.info("File {0} could not be deleted".format(afile))
-                else:
-                    raise err
+def remove_empty(root_directory, files=True, directories=True, dry_run=False, ignore_errors=True):
+    """
+    Generator that removes empty files and then empty directories from a
+    path, yielding each one as it is removed. Every directory is only
+    listed once, files are known to be empty from the size in that
+    listing, and directories are then checked bottom up, so a directory
+    that only held empty files and directories is removed as well.
+
+    Nothing is removed until the generator is iterated.
+
+    ... code:: python
+
+        for removed in reusables.remove_empty("scratch"):
+            print(removed)
+
+    :param root_directory: base directory to start at, is never removed
+    :param files: remove empty files
+    :param directories: remove empty directories
+    :param dry_run: just yield what would be removed
+    :param ignore_errors: Permissions are a pain, just ignore if you blocked
+    :return: generator of removed paths
+    """
+
+    def _remove(func, path):
+        if dry_run:
+            return True
+        try:
+            func(path)
+        except OSError as err:
+            if ignore_errors:
+                logger.info("{0} could not be deleted".format(path))
+                return False
+            raise err
+        return True
 
-    return file_list
+    # Directories in the order they were listed, with their parent and number of entries left
+    order, parents, remaining = [], {}, {}
+    stack = [root_directory]
+    while stack:
+        directory = stack.pop()
+        order.append(directory)
+        remaining[directory] = 0
+        try:
+            entries = os.scandir(directory)
+        except OSError as err:
+            logger.info("Could not list {0} - {1}".format(directory, err))
+            remaining[directory] = 1
+            continue
+        with entries:
+            for entry in entries:
+                remaining[directory] += 1
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        parents[entry.path] = directory
+                        continue
+                    if (
+                        not files
+                        or not entry.is_file(follow_symlinks=False)
+                        or entry.stat(follow_symlinks=False).st_size
+                    ):
+                        continue
+                except OSError:
+                    continue
+                if _remove(os.unlink, entry.path):
+                    remaining[directory] -= 1
+                    yield entry.path
+
+    if not directories:
+        return
+    # Children are always listed after their parents, so go backwards to work bottom up
+    for directory in reversed(order[1:]):
+        if not remaining[directory] and _remove(os.rmdir, directory):
+            remaining[parents[directory]] -= 1
+            yield directory
 
 
-def dup_finder(file_path, directory=".", enable_scandir=False):
+def dup_finder(
+    file_path, directory=".", enable_scandir=False, hash_cache=None, workers=None, executor="thread", index=None
+):
     """
     Check a directory for duplicates of the specified file. This is meant
     for a single file only, for checking a directory for dups, use
@@ -667,9 +2081,14 @@ def dup_finder(file_path, directory=".", enable_scandir=False):
     more extensive ones, in order they are:
 
     1. File size
-    2. First twenty bytes
+    2. Hash of the first and last 64KB
     3. Full SHA256 compare
 
+    When checking many files against the same directory, build a
+    DuplicateIndex once and pass it as index, so the directory is only
+    walked a single time. Files that are hardlinks of file_path are not
+    reported, and other hardlinked files only once.
+
     ... code:: python
 
         list(reusables.dup_finder(
@@ -681,67 +2100,336 @@ def dup_finder(file_path, directory=".", enable_scandir=False):
 
     :param file_path: Path to file to check for duplicates of
     :param directory: Directory to dig recursively into to look for duplicates
+    :param hash_cache: HashCache to look up and store hashes in
+    :param workers: number of files to fully hash at once
+    :param executor: "thread" or "process" pool for the workers
+    :param index: DuplicateIndex to use instead of walking directory
     :return: generators
     """
     if enable_scandir and not scandir_warning_given:
         scandir_warning()
 
-    size = os.path.getsize(file_path)
-    if size == 0:
-        for empty_file in remove_empty_files(directory, dry_run=True):
-            yield empty_file
-    else:
-        with open(file_path, "rb") as f:
-            first_twenty = f.read(20)
-        file_sha256 = file_hash(file_path, "sha256")
-
-        for root, directories, files in os.walk(directory):
-            for each_file in files:
-                test_file = os.path.join(root, each_file)
-                if os.path.getsize(test_file) == size:
-                    try:
-                        with open(test_file, "rb") as f:
-                            test_first_twenty = f.read(20)
-                    except OSError:
-                        logger.warning("Could not open file to compare - {0}".format(test_file))
-                    else:
-                        if first_twenty == test_first_twenty:
-                            if file_hash(test_file, "sha256") == file_sha256:
-                                yield os.path.abspath(test_file)
-
-
-def directory_duplicates(directory, hash_type="md5", **kwargs):
+    if index is None:
+        index = DuplicateIndex(directory, hash_cache=hash_cache, workers=workers, executor=executor)
+    for duplicate in index.find_duplicates_of(file_path):
+        yield duplicate
+
+
+class DuplicateIndex(object):
+    """
+    Index of a directory for repeatedly looking up duplicates of files.
+
+    The directory is walked once when the index is created, grouping files
+    by size. Samples of the first and last sample_size bytes and full
+    hashes are only calculated the first time a file of the same size is
+    looked up, and are kept for later queries.
+
+    The index reflects the directory at the time it was built, create a new
+    one to pick up changes.
+
+    ... code:: python
+
+        index = reusables.DuplicateIndex("Pictures", workers=4)
+        for photo in reusables.find_files("Phone"):
+            print(photo, index.find_duplicates_of(photo))
+
+    :param directory: Directory to index
+    :param hash_type: Type of hash to compare files with
+    :param sample_size: bytes from the start and end of files to compare first
+    :param hash_cache: HashCache to look up and store hashes in
+    :param workers: number of parallel workers to hash files with
+    :param executor: "thread" or "process" pool for the workers
+    :param kwargs: Arguments to pass to scan_files to narrow file types
+    """
+
+    def __init__(
+        self,
+        directory=".",
+        hash_type="sha256",
+        sample_size=65536,
+        hash_cache=None,
+        workers=None,
+        executor="thread",
+        **kwargs,
+    ):
+        self.directory = directory
+        self.hash_type = hash_type
+        self.sample_size = sample_size
+        self.hash_cache = hash_cache
+        self.workers = workers
+        self.executor = executor
+        self.size_map = defaultdict(list)
+        self.links = defaultdict(list)
+        self._keys = {}
+        self._samples = {}
+        self._digests = {}
+        kwargs["abspath"] = True
+        # Only the first name of each inode goes in the size map to be hashed
+        for entry in scan_files(directory, **kwargs):
+            key = _inode_key(entry.path, entry.inode, entry.device)
+            self.links[key].append(entry.path)
+            if len(self.links[key]) == 1:
+                self.size_map[entry.size].append(entry.path)
+                self._keys[entry.path] = key
+
+    def __repr__(self):
+        return "<DuplicateIndex {0} files: {1}>".format(self.directory, len(self))
+
+    def __len__(self):
+        return sum(len(paths) for paths in self.links.values())
+
+    def hardlinks_of(self, path):
+        """
+        List of the files in the index that are the same inode as path,
+        including path itself if it is in the index.
+
+        :param path: file to look for other links to
+        :return: list of absolute paths
+        """
+        stat = os.stat(path)
+        return list(self.links.get(_inode_key(os.path.abspath(path), stat.st_ino, stat.st_dev), []))
+
+    def _fill(self, store, func, paths):
+        missing = [path for path in paths if path not in store]
+        for path, digest in _pool_imap(func, missing, self.workers, self.executor):
+            store[path] = digest
+
+    def find_duplicates_of(self, path):
+        """
+        List of the files in the index with the same content as path.
+        If path itself is in the index it is included. Hardlinked files are
+        only listed once, by the first name found for them, and other
+        links to path are left out, see hardlinks_of.
+
+        :param path: file to look for duplicates of
+        :return: list of absolute paths
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        size = stat.st_size
+        key = _inode_key(path, stat.st_ino, stat.st_dev)
+        found = [path] if key in self.links else []
+        candidates = [candidate for candidate in self.size_map.get(size, []) if self._keys[candidate] != key]
+        if not candidates or size == 0:
+            return found + candidates
+
+        # Files that cannot be read get a None digest and never match
+        sampler = partial(
+            _try_sample_hash, hash_type=self.hash_type, sample_size=self.sample_size, hash_cache=self.hash_cache
+        )
+        self._fill(self._samples, sampler, candidates + [path])
+        sample = self._samples[path]
+        candidates = [candidate for candidate in candidates if sample and self._samples[candidate] == sample]
+        if size <= self.sample_size * 2 or not candidates:
+            return found + candidates
+
+        hasher = partial(_try_file_hash, hash_type=self.hash_type, hash_cache=self.hash_cache)
+        self._fill(self._digests, hasher, candidates + [path])
+        digest = self._digests[path]
+        return found + [candidate for candidate in candidates if digest and self._digests[candidate] == digest]
+
+
+def _inode_key(path, inode, device):
+    """Identify a file by device and inode, or by path where there are no inode numbers"""
+    return (device, inode) if inode else path
+
+
+def directory_duplicates(
+    directory,
+    hash_type="md5",
+    workers=None,
+    executor="thread",
+    sample_size=65536,
+    stats=None,
+    hash_cache=None,
+    hardlinks=None,
+    **kwargs,
+):
     """
     Find all duplicates in a directory. Will return a list, in that list
     are lists of duplicate files.
 
+    Files that are hardlinks of each other (the same inode) are only hashed
+    once, and only the first name found for them is put in the list of
+    duplicates. Pass a list as hardlinks to have it filled with the groups
+    of names that share an inode.
+
+    Files are narrowed down in stages, so only files that could still be
+    duplicates are read any further:
+
+    1. File size
+    2. Hash of the first and last sample_size bytes
+    3. Full hash
+
+    Hashing stages can be spread across a thread or process pool with
+    workers. Pass a dictionary as stats to have it filled with how many
+    files each stage ruled out.
+
     ... code: python
 
-        dups = reusables.directory_duplicates('C:\\Users\\Me\\Pictures')
+        stats = {}
+        dups = reusables.directory_duplicates('C:\\Users\\Me\\Pictures', workers=4, stats=stats)
 
         print(len(dups))
         # 56
         print(dups)
         # [['C:\\Users\\Me\\Pictures\\IMG_20161127.jpg',
         # 'C:\\Users\\Me\\Pictures\\Phone\\IMG_20161127.jpg'], ...
+        print(stats)
+        # {'files': 5230, 'hardlinks': 0, 'size_eliminated': 5012,
+        #  'partial_eliminated': 102, 'full_eliminated': 4, 'duplicates': 112}
 
 
     :param directory: Directory to search
     :param hash_type: Type of hash to perform
-    :param kwargs: Arguments to pass to find_files to narrow file types
+    :param workers: number of parallel workers to hash files with
+    :param executor: "thread" or "process" pool for the workers
+    :param sample_size: bytes from the start and end of files to hash first
+    :param stats: optional dictionary to fill with per stage elimination counts
+    :param hash_cache: HashCache to look up and store full and sample hashes in
+    :param hardlinks: optional list to fill with lists of hardlinked files
+    :param kwargs: Arguments to pass to scan_files to narrow file types
     :return: list of lists of dups"""
-    size_map, hash_map = defaultdict(list), defaultdict(list)
+    size_map = defaultdict(list)
+    inode_map = defaultdict(list)
+    total = 0
+    for entry in scan_files(directory, **kwargs):
+        total += 1
+        links = inode_map[_inode_key(entry.path, entry.inode, entry.device)]
+        links.append(entry.path)
+        if len(links) == 1:
+            size_map[entry.size].append(entry)
+
+    link_groups = [links for links in inode_map.values() if len(links) > 1]
+    if hardlinks is not None:
+        hardlinks.extend(link_groups)
+
+    candidates = [entry for group in size_map.values() if len(group) > 1 for entry in group]
+    size_of = {entry.path: entry.size for entry in candidates}
+    counts = {"files": total, "hardlinks": total - len(inode_map)}
+    counts["size_eliminated"] = len(inode_map) - len(candidates)
+
+    # Files no larger than both samples are hashed entirely by the partial stage
+    partial_hash_map = defaultdict(list)
+    sampler = partial(_sample_hash, hash_type=hash_type, sample_size=sample_size, hash_cache=hash_cache)
+    for path, digest in _pool_imap(sampler, [entry.path for entry in candidates], workers, executor):
+        partial_hash_map[(size_of[path], digest)].append(path)
+
+    complete, needs_full_hash = [], []
+    for (size, _), group in partial_hash_map.items():
+        if len(group) < 2:
+            continue
+        if size <= sample_size * 2:
+            complete.append(group)
+        else:
+            needs_full_hash.extend(group)
+    counts["partial_eliminated"] = len(candidates) - len(needs_full_hash) - sum(len(group) for group in complete)
+
+    hash_map = defaultdict(list)
+    for path, digest in hash_files(
+        needs_full_hash, hash_type=hash_type, workers=workers, executor=executor, hash_cache=hash_cache
+    ):
+        hash_map[(size_of[path], digest)].append(path)
+
+    full_dups = [v for v in hash_map.values() if len(v) > 1]
+    counts["full_eliminated"] = len(needs_full_hash) - sum(len(group) for group in full_dups)
+    duplicates = complete + full_dups
+    counts["duplicates"] = sum(len(group) for group in duplicates)
+
+    logger.debug("Duplicate search of {0} - {1}".format(directory, counts))
+    if stats is not None:
+        stats.update(counts)
+    return duplicates
+
 
-    for item in find_files(directory, disable_pathlib=True, **kwargs):
-        file_size = os.path.getsize(item)
-        size_map[file_size].append(item)
+def dedupe(duplicates, action="hardlink", dry_run=False, ignore_errors=True):
+    """
+    Reclaim the space used by duplicate files, by replacing every file
+    after the first in each group with a hardlink or reflink of the first.
+    Groups are expected to come straight from directory_duplicates, the
+    contents are not compared again.
 
-    for possible_dups in (v for v in size_map.values() if len(v) > 1):
-        for each_item in possible_dups:
-            item_hash = file_hash(each_item, hash_type=hash_type)
-            hash_map[item_hash].append(each_item)
+    Hardlinks make the files the same inode, so a change to one changes
+    all of them. Reflinks (copy on write clones) stay separate files
+    that share data blocks, but are only supported on some file systems,
+    such as Btrfs and XFS.
 
-    return [v for v in hash_map.values() if len(v) > 1]
+    ... code:: python
+
+        dups = reusables.directory_duplicates("Pictures")
+        reusables.dedupe(dups, action="reflink")
+
+    :param duplicates: list of lists of duplicate files
+    :param action: "hardlink" or "reflink"
+    :param dry_run: just return a list of what would be replaced
+    :param ignore_errors: log files that could not be replaced instead of raising
+    :return: list of replaced files
+    """
+    if action not in ("hardlink", "reflink"):
+        raise ValueError('action must be "hardlink" or "reflink", was {0}'.format(action))
+
+    replaced = []
+    for group in duplicates:
+        keep = group[0]
+        for path in group[1:]:
+            try:
+                if os.path.samefile(keep, path):
+                    continue
+                if not dry_run:
+                    _replace_with_link(keep, path, action)
+            except OSError as err:
+                if ignore_errors:
+                    logger.info("File {0} could not be replaced - {1}".format(path, err))
+                    continue
+                raise err
+            replaced.append(path)
+    return replaced
+
+
+def _replace_with_link(source, destination, action):
+    """Link or clone source next to destination, then swap it into place"""
+    temp_path = "{0}.{1}.dedupe".format(destination, os.getpid())
+    try:
+        if action == "hardlink":
+            os.link(source, temp_path)
+        else:
+            with open(source, "rb") as infile, open(temp_path, "wb") as outfile:
+                if not _reflink(infile, outfile):
+                    raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported here", destination)
+            shutil.copystat(destination, temp_path)
+        os.replace(temp_path, destination)
+    finally:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+
+
+def _sample_hash(path, hash_type="md5", sample_size=65536, hash_cache=None):
+    """Hash only the first and last sample_size bytes of a file"""
+    hashed = hashlib.new(hash_type)
+    if hash_cache is not None:
+        stat = os.stat(path)
+        cache_type = "{0}-sample-{1}".format(hash_type, sample_size)
+        cached = hash_cache.get(stat, cache_type)
+        if cached:
+            return cached
+    with open(path, "rb") as infile:
+        hashed.update(infile.read(sample_size))
+        infile.seek(0, os.SEEK_END)
+        size = infile.tell()
+        if size > sample_size:
+            infile.seek(max(sample_size, size - sample_size))
+            hashed.update(infile.read(sample_size))
+    if hash_cache is not None:
+        hash_cache.set(stat, hashed.hexdigest(), cache_type)
+    return hashed.hexdigest()
+
+
+def _try_sample_hash(path, **kwargs):
+    try:
+        return _sample_hash(path, **kwargs)
+    except OSError:
+        logger.warning("Could not open file to compare - {0}".format(path))
+        return None
 
 
 def touch(path):
@@ -879,48 +2567,874 @@ def safe_path(path, replacement="_"):
     return sanitized_path
 
 
-def sync_dirs(dir1, dir2, checksums=True, overwrite=False, only_log_errors=True):
+CopyResult = namedtuple("CopyResult", ["source", "destination", "status", "bytes_copied", "error"])
+CopyResult.__doc__ = """Outcome of copying a single file with copy_files or SyncPlan.execute,
+status is one of copied, delta (only changed blocks rewritten), deleted (SyncPlan deletes) or failed"""
+
+
+def copy_file(source, destination, reflink=True):
+    """
+    Copy a file's contents and permission bits, like shutil.copy, but have
+    the operating system do the work where it can. In order it tries:
+
+    1. A copy on write clone (reflink) on file systems that support it
+    2. os.copy_file_range (server side copy on network file systems)
+    3. os.sendfile
+    4. Reading and writing blocks in Python
+
+    ... code:: python
+
+        reusables.copy_file("big_video.mkv", "/mnt/backup/big_video.mkv")
+        # 2147483648
+
+    :param source: file to copy
+    :param destination: path of the new file (not a directory)
+    :param reflink: try cloning the file before copying it
+    :return: number of bytes copied
+    """
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        raise shutil.SameFileError("{0} and {1} are the same file".format(source, destination))
+    with open(source, "rb") as infile, open(destination, "wb") as outfile:
+        if reflink and _reflink(infile, outfile):
+            copied = os.fstat(infile.fileno()).st_size
+        else:
+            copied = _copy_data(infile, outfile)
+    shutil.copymode(source, destination)
+    return copied
+
+
+def copy_files(files, workers=4, reflink=True, delta=False):
+    """
+    Copy many files in a thread pool, yields a CopyResult for every file as it
+    finishes. Failed copies are reported in the result instead of raised.
+
+    With delta, destination files that already exist are updated in place
+    with delta_copy, and reported with a status of "delta".
+
+    ... code:: python
+
+        for result in reusables.copy_files({"a.iso": "/mnt/a.iso", "b.iso": "/mnt/b.iso"}, workers=2):
+            print(result.destination, result.status, result.bytes_copied)
+
+    :param files: dictionary (or iterable of tuples) of source and destination paths
+    :param workers: number of files to copy at once
+    :param reflink: try cloning the files before copying them
+    :param delta: only rewrite the changed blocks of existing destination files
+    :return: generator of CopyResult
+    """
+    pairs = files.items() if isinstance(files, dict) else files
+    copier = partial(_copy_result, reflink=reflink, delta=delta)
+    for _, result in _pool_imap(copier, pairs, workers, "thread"):
+        yield result
+
+
+def _copy_result(pair, reflink=True, delta=False):
+    source, destination = pair
+    try:
+        if delta and os.path.isfile(destination):
+            return CopyResult(source, destination, "delta", delta_copy(source, destination), None)
+        copied = copy_file(source, destination, reflink=reflink)
+    except OSError as err:
+        return CopyResult(source, destination, "failed", 0, err)
+    return CopyResult(source, destination, "copied", copied, None)
+
+
+def delta_copy(source, destination, block_size=1024 * 1024, hash_type="sha256", workers=4):
+    """
+    Update an existing copy of a file in place, only rewriting the blocks
+    that differ from the source, rsync style. Both files are hashed as fixed
+    size blocks with file_hash_tree, changed blocks are written into the
+    destination, it is truncated or extended to the source's size, and the
+    result is verified against the source's root hash.
+
+    Only worth it when most of a large file is unchanged (appended logs,
+    modified disk images), as both files are still read in full.
+
+    ... code:: python
+
+        reusables.delta_copy("vm.qcow2", "/mnt/backup/vm.qcow2")
+        # 3145728
+
+    :param source: file to copy from
+    :param destination: existing file to update
+    :param block_size: size of the blocks to compare
+    :param hash_type: string name of the hash used to compare blocks
+    :param workers: number of blocks to hash at once
+    :return: number of bytes written to the destination
+    """
+    source_tree = file_hash_tree(source, hash_type, chunk_size=block_size, workers=workers)
+    destination_tree = file_hash_tree(destination, hash_type, chunk_size=block_size, workers=workers)
+
+    written = 0
+    buffer = bytearray(block_size)
+    with open(source, "rb", buffering=0) as infile, open(destination, "r+b") as outfile, memoryview(buffer) as view:
+        for index, digest in enumerate(source_tree.chunks):
+            if index < len(destination_tree.chunks) and destination_tree.chunks[index] == digest:
+                continue
+            offset = index * block_size
+            size = _pread_into(infile, view, offset)
+            outfile.seek(offset)
+            with view[:size] as block:
+                outfile.write(block)
+            written += size
+        outfile.truncate(source_tree.size)
+
+    if file_hash_tree(destination, hash_type, chunk_size=block_size, workers=workers).root != source_tree.root:
+        raise OSError("{0} does not match {1} after delta copy".format(destination, source))
+    shutil.copymode(source, destination)
+    logger.debug("Delta copy of {0} wrote {1} of {2} bytes".format(source, written, source_tree.size))
+    return written
+
+
+def _reflink(infile, outfile):
+    if not fcntl or not hasattr(fcntl, "ioctl") or not nix_based:
+        return False
+    try:
+        fcntl.ioctl(outfile.fileno(), _FICLONE, infile.fileno())
+    except OSError:
+        return False
+    return True
+
+
+_FICLONE = 0x40049409
+_copy_fallback_errors = {
+    getattr(errno, name)
+    for name in ("EXDEV", "ENOSYS", "EINVAL", "EOPNOTSUPP", "ENOTSUP", "ENOTSOCK", "EBADF")
+    if hasattr(errno, name)
+}
+
+
+def _copy_data(infile, outfile, block_size=1024 * 1024):
+    in_fd, out_fd = infile.fileno(), outfile.fileno()
+    copied = 0
+    for kernel_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if kernel_copy is None:
+            continue
+        try:
+            while True:
+                if kernel_copy is os.copy_file_range:
+                    sent = kernel_copy(in_fd, out_fd, _kernel_copy_size)
+                else:
+                    sent = kernel_copy(out_fd, in_fd, None, _kernel_copy_size)
+                if not sent:
+                    return copied
+                copied += sent
+        except OSError as err:
+            if copied or err.errno not in _copy_fallback_errors:
+                raise
+    buffer = bytearray(block_size)
+    with memoryview(buffer) as view:
+        size = infile.readinto(view)
+        while size:
+            with view[:size] as block:
+                outfile.write(block)
+            copied += size
+            size = infile.readinto(view)
+    return copied
+
+
+_kernel_copy_size = 1024 * 1024 * 1024
+
+
+SyncOperation = namedtuple("SyncOperation", ["action", "source", "destination", "size"])
+SyncOperation.__doc__ = """Single step of a SyncPlan, action is one of copy, overwrite, skip or delete"""
+
+
+class SyncPlan(object):
+    """
+    List of operations needed to sync two directories, created by plan_sync.
+    Nothing is changed on disk until execute is called, so the plan can be
+    inspected (or logged) first to preview how much work a sync will be.
+
+    ... code:: python
+
+        plan = reusables.plan_sync("photos", "/mnt/backup/photos", overwrite=True, delete=True)
+        plan.totals
+        # {'copy': {'files': 12, 'bytes': 48211332}, 'overwrite': {'files': 1, 'bytes': 5120},
+        #  'skip': {'files': 8840, 'bytes': 30552331220}, 'delete': {'files': 2, 'bytes': 1024}}
+        results = plan.execute(workers=8)
+
+    :param operations: list of SyncOperation
+    :param manifest: path to the JSON manifest to save after executing
+    :param source_root: directory being synced from
+    :param destination_root: directory being synced to
+    """
+
+    actions = ("copy", "overwrite", "skip", "delete")
+
+    def __init__(self, operations=None, manifest=None, source_root=None, destination_root=None):
+        self.operations = operations or []
+        self.manifest = manifest
+        self.source_root = source_root
+        self.destination_root = destination_root
+        self._synced = {}
+        self._pending = {}
+
+    def __repr__(self):
+        return "<SyncPlan {0}>".format(
+            ", ".join("{0}: {1[files]}".format(action, totals) for action, totals in self.totals.items())
+        )
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    @property
+    def totals(self):
+        """Number of files and bytes for each action"""
+        totals = {action: {"files": 0, "bytes": 0} for action in self.actions}
+        for operation in self.operations:
+            totals[operation.action]["files"] += 1
+            totals[operation.action]["bytes"] += operation.size
+        return totals
+
+    def by_action(self, action):
+        """
+        :param action: copy, overwrite, skip or delete
+        :return: list of operations of that action
+        """
+        return [operation for operation in self.operations if operation.action == action]
+
+    def _add(self, action, source, destination, size, relative=None, path_one=None, path_two=None, digest=None):
+        self.operations.append(SyncOperation(action, source, destination, size))
+        if action in ("copy", "overwrite"):
+            self._pending[(source, destination)] = (relative, path_one, path_two, digest)
+
+    def _record(self, relative, stat_one, stat_two, digest=None):
+        self._synced[relative] = [stat_one.size, stat_one.mtime_ns, stat_two.size, stat_two.mtime_ns, digest]
+
+    def execute(self, workers=None, only_log_errors=True, delta=False, reflink=True):
+        """
+        Run the plan. Copies are grouped by destination directory, each
+        directory is created once, and the files are copied with copy_files.
+        Deletes happen last, and their now empty directories are removed.
+
+        :param workers: number of files to copy at once
+        :param only_log_errors: Do not raise copy or delete errors, only log them
+        :param delta: overwrite files by only rewriting the blocks that changed
+        :param reflink: try cloning the files before copying them
+        :return: list of CopyResult for every file copied or deleted
+        """
+        copies = sorted(
+            (operation for operation in self.operations if operation.action in ("copy", "overwrite")),
+            key=lambda operation: operation.destination,
+        )
+        for directory in sorted({os.path.dirname(operation.destination) for operation in copies}):
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError:
+                if not only_log_errors:
+                    raise
+                logger.error("Could not create directory {}".format(directory))
+        for operation in copies:
+            if operation.action == "copy":
+                logger.info("Copying {} to {}".format(operation.source, operation.destination))
+            else:
+                logger.info("Overwriting {}".format(operation.destination))
+
+        results = []
+        for result in copy_files(
+            [(operation.source, operation.destination) for operation in copies],
+            workers=workers,
+            reflink=reflink,
+            delta=delta,
+        ):
+            results.append(result)
+            if result.error:
+                if not only_log_errors:
+                    raise result.error
+                logger.error("Could not copy {} to {}".format(result.source, result.destination))
+                continue
+            relative, path_one, path_two, digest = self._pending[(result.source, result.destination)]
+            if relative is not None:
+                self._record(relative, _file_entry_from(path_one), _file_entry_from(path_two), digest)
+        if results:
+            logger.info(
+                "Copied {0} files, {1} bytes".format(
+                    sum(1 for result in results if not result.error), sum(result.bytes_copied for result in results)
+                )
+            )
+
+        emptied = set()
+        for operation in self.by_action("delete"):
+            logger.info("Deleting {}".format(operation.destination))
+            try:
+                os.unlink(operation.destination)
+            except OSError as err:
+                if not only_log_errors:
+                    raise
+                logger.error("Could not delete {}".format(operation.destination))
+                results.append(CopyResult(None, operation.destination, "failed", 0, err))
+            else:
+                results.append(CopyResult(None, operation.destination, "deleted", 0, None))
+                emptied.add(os.path.dirname(operation.destination))
+        # Remove directories left empty by deletes, if they do not exist in the source either
+        for directory in sorted(emptied, key=len, reverse=True):
+            while self.destination_root and directory.startswith(self.destination_root + os.sep):
+                relative = directory[len(self.destination_root) + 1 :]
+                if self.source_root and os.path.isdir(os.path.join(self.source_root, relative)):
+                    break
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+        if self.manifest:
+            save_json(self._synced, self.manifest, indent=None)
+        return results
+
+
+def _file_entry_from(path):
+    stat = os.stat(path)
+    return FileEntry(path, os.path.basename(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def plan_sync(
+    dir1,
+    dir2,
+    checksums=True,
+    overwrite=False,
+    delete=False,
+    two_way=False,
+    hash_cache=None,
+    workers=None,
+    executor="thread",
+    manifest=None,
+):
+    """
+    Work out everything needed to make directory 2 match directory 1,
+    without changing anything. Both directories are walked once with
+    scan_files, and files of the same size are checksummed in parallel with
+    hash_files (unless the manifest shows they have not changed since they
+    were last synced, see sync_dirs).
+
+    With delete, files in directory 2 that are not in directory 1 are
+    deleted (mirror). With two_way, they are copied to directory 1 instead,
+    and when overwrite is set, the most recently modified version of a
+    changed file wins.
+
+    :param dir1: Copy from
+    :param dir2: Copy too
+    :param checksums: Use hashes to make sure file contents match
+    :param overwrite: If files don't match, overwrite with file from dir 1
+    :param delete: Delete files in dir 2 that are not in dir 1
+    :param two_way: Copy files only in dir 2 to dir 1 as well
+    :param hash_cache: HashCache to look up and store checksums in
+    :param workers: number of files to checksum at once
+    :param executor: "thread" or "process" pool for the checksum workers
+    :param manifest: path to a JSON manifest of synced files to read and update
+    :return: SyncPlan
+    """
+    if delete and two_way:
+        raise ValueError("Cannot delete files from the destination when syncing both ways")
+
+    plan = SyncPlan(manifest=manifest, source_root=dir1, destination_root=dir2)
+    previous = load_json(manifest) if manifest and os.path.exists(manifest) else {}
+    ones = {entry.path[len(dir1) + 1 :]: entry for entry in scan_files(dir1)}
+    twos = {entry.path[len(dir2) + 1 :]: entry for entry in scan_files(dir2)} if os.path.isdir(dir2) else {}
+
+    def replace(relative, one, two, digest=None):
+        if two_way and two.mtime_ns > one.mtime_ns:
+            plan._add("overwrite", two.path, one.path, two.size, relative, one.path, two.path, digest)
+        else:
+            plan._add("overwrite", one.path, two.path, one.size, relative, one.path, two.path, digest)
+
+    to_compare = {}
+    for relative, one in ones.items():
+        two = twos.get(relative)
+        if two is None:
+            path_two = os.path.join(dir2, relative)
+            plan._add("copy", one.path, path_two, one.size, relative, one.path, path_two)
+        elif one.size != two.size:
+            logger.info("File sizes do not match: {} - {}".format(one.path, two.path))
+            if overwrite:
+                replace(relative, one, two)
+            else:
+                plan._add("skip", one.path, two.path, one.size)
+        elif checksums:
+            # Files are only hashed if they changed since the manifest marked them as synced
+            known = previous.get(relative) or [None] * 5
+            if known[0:4] == [one.size, one.mtime_ns, two.size, two.mtime_ns]:
+                plan._synced[relative] = known
+                plan._add("skip", one.path, two.path, one.size)
+                continue
+            known_one = known[4] if known[0:2] == [one.size, one.mtime_ns] else None
+            known_two = known[4] if known[2:4] == [two.size, two.mtime_ns] else None
+            to_compare[relative] = (one, two, known_one, known_two)
+        else:
+            # Keep what the manifest knows about files that have not changed since
+            known = previous.get(relative)
+            if known and known[0:4] == [one.size, one.mtime_ns, two.size, two.mtime_ns]:
+                plan._synced[relative] = known
+            plan._add("skip", one.path, two.path, one.size)
+
+    for relative, two in twos.items():
+        if relative in ones:
+            continue
+        if two_way:
+            path_one = os.path.join(dir1, relative)
+            plan._add("copy", two.path, path_one, two.size, relative, path_one, two.path)
+        elif delete:
+            plan._add("delete", None, two.path, two.size)
+
+    if to_compare:
+        needs_hash = chain(
+            (one.path for one, _, known_one, _ in to_compare.values() if not known_one),
+            (two.path for _, two, _, known_two in to_compare.values() if not known_two),
+        )
+        digests = dict(hash_files(needs_hash, workers=workers, executor=executor, hash_cache=hash_cache))
+        for relative, (one, two, known_one, known_two) in to_compare.items():
+            digest = known_one or digests[one.path]
+            if digest == (known_two or digests[two.path]):
+                plan._record(relative, one, two, digest)
+                plan._add("skip", one.path, two.path, one.size)
+                continue
+            logger.warning("Files do not match: {} - {}".format(one.path, two.path))
+            if overwrite:
+                replace(relative, one, two, digest if not two_way or two.mtime_ns <= one.mtime_ns else None)
+            else:
+                plan._add("skip", one.path, two.path, one.size)
+
+    return plan
+
+
+def sync_dirs(
+    dir1,
+    dir2,
+    checksums=True,
+    overwrite=False,
+    only_log_errors=True,
+    hash_cache=None,
+    workers=None,
+    executor="thread",
+    manifest=None,
+    delta=False,
+    delete=False,
+    two_way=False,
+):
     """
     Make sure all files in directory 1 exist in directory 2.
 
+    This is plan_sync followed by executing the plan, use plan_sync
+    directly to preview what would be done.
+
+    Files are copied with copy_file, which lets the operating system copy
+    the data (or clone it) without passing through Python. Set workers to
+    copy (and checksum) multiple files at once. With delta, files being
+    overwritten are updated in place with delta_copy instead.
+
+    With a manifest file, the size, modification time and hash of every
+    file known to be in sync is saved after the run. On later runs, files
+    whose stat data still matches the manifest are not hashed again, so
+    checksums only cost anything for files that changed.
+
+    ... code:: python
+
+        reusables.sync_dirs("photos", "/mnt/backup/photos", manifest="/mnt/backup/photos.manifest.json")
+
     :param dir1: Copy from
     :param dir2: Copy too
     :param checksums: Use hashes to make sure file contents match
     :param overwrite: If sizes don't match, overwrite with file from dir 1
     :param only_log_errors: Do not raise copy errors, only log them
-    :return: None
+    :param hash_cache: HashCache to look up and store checksums in
+    :param workers: number of files to checksum and copy at once
+    :param executor: "thread" or "process" pool for the checksum workers
+    :param manifest: path to a JSON manifest of synced files to read and update
+    :param delta: overwrite files by only rewriting the blocks that changed
+    :param delete: Delete files in dir 2 that are not in dir 1
+    :param two_way: Copy files only in dir 2 to dir 1 as well, newest file wins on overwrite
+    :return: list of CopyResult for every file copied or deleted
     """
+    plan = plan_sync(
+        dir1,
+        dir2,
+        checksums=checksums,
+        overwrite=overwrite,
+        delete=delete,
+        two_way=two_way,
+        hash_cache=hash_cache,
+        workers=workers,
+        executor=executor,
+        manifest=manifest,
+    )
+    return plan.execute(workers=workers, only_log_errors=only_log_errors, delta=delta)
 
-    def cp(f1, f2):
-        try:
-            shutil.copy(f1, f2)
-        except OSError:
-            if only_log_errors:
-                logger.error("Could not copy {} to {}".format(f1, f2))
-            else:
-                raise
 
-    for file in find_files(dir1, disable_pathlib=True):
-        path_two = os.path.join(dir2, file[len(dir1) + 1 :])
-        try:
-            os.makedirs(os.path.dirname(path_two))
-        except OSError:
-            pass  # Because exists_ok doesn't exist in 2.x
-        if os.path.exists(path_two):
-            if os.path.getsize(file) != os.path.getsize(path_two):
-                logger.info("File sizes do not match: {} - {}".format(file, path_two))
-                if overwrite:
-                    logger.info("Overwriting {}".format(path_two))
-                    cp(file, path_two)
-            elif checksums and (file_hash(file) != file_hash(path_two)):
-                logger.warning("Files do not match: {} - {}".format(file, path_two))
-                if overwrite:
-                    logger.info(
-                        "Overwriting {}".format(
-                            file,
-                        )
-                    )
-                    cp(file, path_two)
+SnapshotEntry = namedtuple("SnapshotEntry", ["path", "size", "mtime_ns", "inode"])
+SnapshotEntry.__doc__ = """Single file of a Snapshot, path is relative to the snapshot directory"""
+
+DiffEntry = namedtuple("DiffEntry", ["action", "path", "old", "new"])
+DiffEntry.__doc__ = """Change found by diff, action is one of added, removed, modified or moved"""
+
+
+class Snapshot(object):
+    """
+    Record of the files in a directory at one point in time, kept as a list
+    of SnapshotEntry sorted by relative path. Compare two snapshots with
+    diff, and save them between runs as compact JSON.
+
+    :param directory: directory the snapshot was taken of
+    :param entries: list of SnapshotEntry
+    :param created: unix time the snapshot was taken at
+    """
+
+    def __init__(self, directory, entries=None, created=None):
+        self.directory = directory
+        self.entries = sorted(entries or [])
+        self.created = created
+
+    def __repr__(self):
+        return "<Snapshot {0} files: {1}>".format(self.directory, len(self))
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self, json_file):
+        """
+        Save the snapshot to a JSON file, entries are stored as plain lists.
+
+        :param json_file: path to save to
+        """
+        data = {"directory": self.directory, "created": self.created, "entries": self.entries}
+        save_json(data, json_file, indent=None)
+
+    @classmethod
+    def load(cls, json_file):
+        """
+        Load a snapshot saved with Snapshot.save
+
+        :param json_file: path to load from
+        :return: Snapshot
+        """
+        data = load_json(json_file)
+        return cls(data["directory"], [SnapshotEntry(*entry) for entry in data["entries"]], data["created"])
+
+
+def snapshot(directory=".", **kwargs):
+    """
+    Take a Snapshot of the files in a directory, with a single stat of each
+    file from scan_files.
+
+    ... code:: python
+
+        before = reusables.snapshot("project")
+        before.save("project.snapshot.json")
+
+        # Later on
+        before = reusables.Snapshot.load("project.snapshot.json")
+        for change in reusables.diff(before, reusables.snapshot("project")):
+            print(change.action, change.path)
+        # modified src/main.py
+        # moved docs/new_name.rst
+
+    :param directory: directory to take a snapshot of
+    :param kwargs: Arguments to pass to scan_files to narrow file types
+    :return: Snapshot
+    """
+    created = time.time()
+    prefix = len(os.path.join(os.path.abspath(directory) if kwargs.get("abspath") else directory, ""))
+    entries = [
+        SnapshotEntry(entry.path[prefix:], entry.size, entry.mtime_ns, entry.inode)
+        for entry in scan_files(directory, **kwargs)
+    ]
+    return Snapshot(directory, entries, created)
+
+
+def diff(old, new):
+    """
+    Generator of the changes between two snapshots of a directory. Both
+    snapshots are walked together in path order, so files that changed are
+    yielded as they are found, without building a dictionary of either
+    snapshot. Files that are removed and added with the same inode and size
+    are reported once as moved, after the other changes.
+
+    :param old: earlier Snapshot
+    :param new: later Snapshot
+    :return: generator of DiffEntry
+    """
+    removed, added = {}, {}
+    old_entries, new_entries = iter(old), iter(new)
+    old_entry, new_entry = next(old_entries, None), next(new_entries, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and old_entry.path < new_entry.path):
+            removed[old_entry.path] = old_entry
+            old_entry = next(old_entries, None)
+        elif old_entry is None or new_entry.path < old_entry.path:
+            added[new_entry.path] = new_entry
+            new_entry = next(new_entries, None)
         else:
-            logger.info("Copying {} to {}".format(file, path_two))
-            cp(file, path_two)
+            if old_entry[1:] != new_entry[1:]:
+                yield DiffEntry("modified", new_entry.path, old_entry, new_entry)
+            old_entry, new_entry = next(old_entries, None), next(new_entries, None)
+
+    # Without inode numbers (0) a move cannot be told apart from a new file
+    moved_from = {(entry.inode, entry.size): entry for entry in removed.values() if entry.inode}
+    for path in sorted(added):
+        entry = added[path]
+        source = moved_from.pop((entry.inode, entry.size), None) if entry.inode else None
+        if source is not None:
+            del removed[source.path]
+            del added[path]
+            yield DiffEntry("moved", path, source, entry)
+    for path in sorted(removed):
+        yield DiffEntry("removed", path, removed[path], None)
+    for path in sorted(added):
+        yield DiffEntry("added", path, None, added[path])
+
+
+WatchEvent = namedtuple("WatchEvent", ["action", "path"])
+WatchEvent.__doc__ = """Change seen by watch, action is one of created, modified or deleted"""
+
+
+def watch(
+    directory=".",
+    ext=None,
+    name=None,
+    match_case=False,
+    disable_glob=False,
+    depth=None,
+    abspath=False,
+    exclude=None,
+    exclude_dirs=None,
+    matcher=None,
+    interval=1.0,
+    timeout=None,
+    polling=False,
+):
+    """
+    Generator of changes to files in a directory, taking the same filters as
+    find_files, instead of calling find_files over and over.
+
+    On Linux the kernel reports changes through inotify (loaded with ctypes,
+    no extra dependencies), so only changed files cost anything. Each new
+    file is reported as created, and again as modified whenever a writer
+    closes it. Files moved in or out of the directory are reported as
+    created or deleted, including every file in a directory that is moved.
+
+    Everywhere else, or with polling set, a snapshot of the directory is
+    taken every interval seconds and compared to the last one with diff.
+
+    ... code:: python
+
+        for event in reusables.watch("incoming", ext=".csv"):
+            if event.action == "modified":
+                process(event.path)
+
+    :param directory: Top location to watch
+    :param ext: Extensions of the file you are looking for
+    :param name: Part of the file name
+    :param match_case: If name or ext has to be a direct match or not
+    :param disable_glob: Do not look for globable names or use glob magic check
+    :param depth: How many directories down to watch
+    :param abspath: Return files with their absolute paths
+    :param exclude: glob pattern(s) of file names to leave out
+    :param exclude_dirs: glob pattern(s) of directory names to not watch
+    :param matcher: FileMatcher to use instead of ext, name, match_case and disable_glob
+    :param interval: seconds between snapshots when polling
+    :param timeout: stop after this many seconds without any change, default is to never stop
+    :param polling: always compare snapshots instead of using inotify
+    :return: generator of WatchEvent
+    """
+    if matcher is None:
+        matcher = FileMatcher(ext=ext, name=name, match_case=match_case, disable_glob=disable_glob)
+    if abspath:
+        directory = os.path.abspath(directory)
+
+    inotify = None if polling else _Inotify.create()
+    if inotify is None:
+        events = _poll_events(
+            directory,
+            interval,
+            timeout,
+            matcher=matcher,
+            depth=depth,
+            exclude=exclude,
+            exclude_dirs=exclude_dirs,
+        )
+    else:
+        events = _inotify_events(
+            inotify, directory, timeout, matcher, _compile_globs(exclude), _compile_globs(exclude_dirs), depth
+        )
+    for event in events:
+        yield event
+
+
+def _poll_events(directory, interval, timeout, **scan_kwargs):
+    previous = snapshot(directory, **scan_kwargs)
+    last_change = time.monotonic()
+    while True:
+        wait = interval
+        if timeout is not None:
+            remaining = timeout - (time.monotonic() - last_change)
+            if remaining <= 0:
+                return
+            wait = min(wait, remaining)
+        time.sleep(wait)
+
+        current = snapshot(directory, **scan_kwargs)
+        for change in diff(previous, current):
+            last_change = time.monotonic()
+            if change.action == "moved":
+                yield WatchEvent("deleted", os.path.join(directory, change.old.path))
+                yield WatchEvent("created", os.path.join(directory, change.path))
+            else:
+                action = {"added": "created", "removed": "deleted"}.get(change.action, change.action)
+                yield WatchEvent(action, os.path.join(directory, change.path))
+        previous = current
+
+
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_DONT_FOLLOW = 0x2000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_inotify_event = struct.Struct("iIII")
+
+
+class _Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify calls"""
+
+    mask = _IN_CREATE | _IN_CLOSE_WRITE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_ONLYDIR | _IN_DONT_FOLLOW
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify")
+
+    @classmethod
+    def create(cls):
+        """Start inotify, or return None where it is not available"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            return cls(libc) if hasattr(libc, "inotify_init1") else None
+        except (OSError, TypeError) as err:
+            logger.debug("inotify not available - {0}".format(err))
+            return None
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            errno_value = ctypes.get_errno()
+            raise OSError(errno_value, os.strerror(errno_value), path)
+        return wd
+
+    def remove(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """List of (watch descriptor, mask, name) events, waiting up to timeout seconds for any"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _inotify_events(inotify, directory, timeout, matcher, exclude, exclude_dirs, depth):
+    watches = {}
+    # Wanted file names known in each watched directory, to report when a directory is moved away
+    known = defaultdict(set)
+
+    def wanted(file_name):
+        return matcher.match(file_name) and not (exclude and exclude.match(file_name))
+
+    def add_tree(path, level, new):
+        # Watch before listing, so nothing created in between is missed
+        stack = [(path, level)]
+        while stack:
+            root, root_level = stack.pop()
+            try:
+                watches[inotify.add(root)] = (root, root_level)
+            except OSError as err:
+                logger.warning("Could not watch {0} - {1}".format(root, err))
+                continue
+            _, files, sub_directories = _list_directory(root, root_level, depth, exclude_dirs)
+            for entry in files:
+                if wanted(entry.name):
+                    known[root].add(entry.name)
+                    if new:
+                        yield WatchEvent("created", entry.path)
+            stack.extend((sub_directory, root_level + 1) for sub_directory in sub_directories)
+
+    try:
+        for _ in add_tree(directory, 0, False):
+            pass
+        last_change = time.monotonic()
+        while True:
+            wait = None
+            if timeout is not None:
+                wait = timeout - (time.monotonic() - last_change)
+                if wait <= 0:
+                    return
+            events = inotify.read(wait)
+            if events:
+                last_change = time.monotonic()
+            for wd, mask, file_name in events:
+                if mask & _IN_Q_OVERFLOW:
+                    logger.warning("Too many changes at once in {0}, some were not seen".format(directory))
+                    continue
+                if mask & _IN_IGNORED:
+                    if wd in watches:
+                        known.pop(watches.pop(wd)[0], None)
+                    continue
+                if wd not in watches:
+                    continue
+                root, level = watches[wd]
+                path = os.path.join(root, file_name)
+                if mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO):
+                        if (not depth or level + 1 < depth) and not (exclude_dirs and exclude_dirs.match(file_name)):
+                            for event in add_tree(path, level + 1, True):
+                                yield event
+                    elif mask & _IN_MOVED_FROM:
+                        # Nothing is reported for the files inside a moved directory, so report them here
+                        moved = [
+                            (watched, moved_wd)
+                            for moved_wd, (watched, _) in watches.items()
+                            if watched == path or watched.startswith(path + os.sep)
+                        ]
+                        for watched, moved_wd in sorted(moved):
+                            for known_name in sorted(known.pop(watched, ())):
+                                yield WatchEvent("deleted", os.path.join(watched, known_name))
+                            inotify.remove(moved_wd)
+                            watches.pop(moved_wd)
+                    continue
+                if not wanted(file_name):
+                    continue
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    known[root].add(file_name)
+                    yield WatchEvent("created", path)
+                elif mask & _IN_CLOSE_WRITE:
+                    yield WatchEvent("modified", path)
+                else:
+                    known[root].discard(file_name)
+                    yield WatchEvent("deleted", path)
+    finally:
+        inotify.close()
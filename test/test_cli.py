@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from reusables.cli import cmd, pushd, popd, pwd, cd, ls, find, head, cat, tail, cp
-from .common_test_data import BaseTestClass, data_dr, os
+from .common_test_data import BaseTestClass, data_dr, os, shutil
 
 
 class TestCLI(BaseTestClass):
@@ -70,6 +70,27 @@ class TestCLI(BaseTestClass):
     def test_find(self):
         assert self.ex in find(directory=data_dr)
 
+    def test_cp_workers(self):
+        folder = os.path.join(data_dr, "cp_workers")
+        os.mkdir(folder)
+        try:
+            results = cp([self.ex, os.path.join(data_dr, "test_config.ini")], folder, workers=2)
+            assert sorted(result.status for result in results) == ["copied", "copied"], results
+            assert sum(result.bytes_copied for result in results) == os.path.getsize(self.ex) + os.path.getsize(
+                os.path.join(data_dr, "test_config.ini")
+            )
+            with open(os.path.join(folder, "ex.txt"), "rb") as copied, open(self.ex, "rb") as original:
+                assert copied.read() == original.read()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_cp_same_file(self):
+        with open(self.ex, "rb") as f:
+            original = f.read()
+        self.assertRaises(shutil.SameFileError, cp, self.ex, os.path.dirname(self.ex), overwrite=True)
+        with open(self.ex, "rb") as f:
+            assert f.read() == original
+
     def test_cp(self):
         try:
             cp(self.ex, "test_file")
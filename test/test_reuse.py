@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import shutil
 import tarfile
+import zipfile
 import tempfile
 import subprocess
+import threading
+import time
 import unittest
 
 import reusables
@@ -90,6 +94,100 @@ Key2 = Value2
         os.unlink(os.path.join(test_root, "test_hash"))
         assert resp == valid, (resp, valid)
 
+    def test_hash_file_multiple(self):
+        hash_file = os.path.join(test_root, "test_hash_multi")
+        with open(hash_file, "w") as out_hash:
+            out_hash.write("1234" * 10000)
+        try:
+            resp = reusables.file_hash(hash_file, hash_type=["md5", "sha256"], buffer=bytearray(1000))
+            assert resp == {
+                "md5": reusables.file_hash(hash_file, "md5"),
+                "sha256": reusables.file_hash(hash_file, "sha256", block_size=7),
+            }, resp
+        finally:
+            os.unlink(hash_file)
+
+    def test_hash_file_modes(self):
+        hash_file = os.path.join(test_root, "test_hash_modes")
+        with open(hash_file, "wb") as out_hash:
+            out_hash.write(b"1234" * 100000)
+        try:
+            expected = reusables.file_hash(hash_file, "sha1", block_size=65536, mode="readinto")
+            assert reusables.file_hash(hash_file, "sha1", mode="mmap") == expected
+            assert reusables.file_hash(hash_file, "sha1", mode="mmap", block_size=1000) == expected
+            assert reusables.file_hash(hash_file, "sha1") == expected
+            self.assertRaises(ValueError, reusables.file_hash, hash_file, mode="sendfile")
+            open(hash_file, "wb").close()
+            empty = reusables.file_hash(hash_file, "sha1", mode="mmap")
+            assert empty == reusables.variables.hashes.empty_file.sha1, empty
+        finally:
+            os.unlink(hash_file)
+
+    def test_hash_files(self):
+        self._extract_structure()
+        files = reusables.find_files_list(test_structure, disable_pathlib=True)
+        expected = {path: reusables.file_hash(path, "sha1") for path in files}
+        for executor in ("thread", "process"):
+            resp = dict(reusables.hash_files(iter(files), "sha1", workers=3, executor=executor))
+            assert resp == expected, resp
+        missing = os.path.join(test_structure, "does_not_exist")
+        resp = dict(reusables.hash_files(files + [missing], "sha1", ignore_errors=True))
+        assert resp == expected
+        self.assertRaises(OSError, list, reusables.hash_files([missing], workers=2))
+
+    def test_file_hash_tree(self):
+        import hashlib
+
+        hash_file = os.path.join(test_root, "test_hash_tree")
+        data = os.urandom(10000)
+        with open(hash_file, "wb") as out_hash:
+            out_hash.write(data)
+        try:
+            tree = reusables.file_hash_tree(hash_file, "sha1", chunk_size=4096, workers=3, block_size=1000)
+            chunks = [hashlib.sha1(data[i : i + 4096]).hexdigest() for i in range(0, len(data), 4096)]
+            assert tree.chunks == chunks, tree
+            assert tree.root == hashlib.sha1(b"".join(bytes.fromhex(c) for c in chunks)).hexdigest()
+            assert tree.size == 10000 and tree.chunk_size == 4096
+            assert reusables.file_hash_tree(hash_file, "sha1", chunk_size=4096, workers=None) == tree
+
+            with open(hash_file, "r+b") as out_hash:
+                out_hash.seek(5000)
+                out_hash.write(b"changed")
+            changed = reusables.file_hash_tree(hash_file, "sha1", chunk_size=4096)
+            assert [a != b for a, b in zip(tree.chunks, changed.chunks)] == [False, True, False]
+            assert changed.root != tree.root
+        finally:
+            os.unlink(hash_file)
+
+    def test_hash_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            hash_file = os.path.join(tmpdir, "test_hash")
+            with open(hash_file, "w") as out_hash:
+                out_hash.write("1234")
+            with reusables.HashCache(os.path.join(tmpdir, "hashes.sqlite")) as cache:
+                assert reusables.file_hash(hash_file, hash_cache=cache) == "81dc9bdb52d04dc20036dbd8313ed055"
+                assert cache.get(os.stat(hash_file)) == "81dc9bdb52d04dc20036dbd8313ed055"
+                assert cache.get(os.stat(hash_file), "sha256") is None
+
+                # An unchanged file is never read again
+                cache.set(os.stat(hash_file), "00ff", "md5")
+                assert reusables.file_hash(hash_file, hash_cache=cache) == "00ff"
+                assert reusables.file_hash(hash_file, hash_cache=cache, hex_digest=False) == b"\x00\xff"
+
+                with open(hash_file, "w") as out_hash:
+                    out_hash.write("12345")
+                assert reusables.file_hash(hash_file, hash_cache=cache) == "827ccb0eea8a706c4c34a16891f84e7b"
+
+                # 64 bit file ids (NFS, Windows) do not fit in a signed sqlite integer
+                large = reusables.FileEntry(hash_file, "test_hash", 5, 1, (1 << 63) + 5, (1 << 63) + 7)
+                assert cache.get(large) is None
+                cache.set(large, "abcd")
+                assert cache.get(large) == "abcd"
+                assert cache.get(large._replace(inode=5)) is None
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_bad_hash_type(self):
         self.assertRaises(ValueError, reusables.file_hash, "", hash_type="sham5")
 
@@ -149,6 +247,57 @@ Key2 = Value2
         resp = [x for x in resp]
         assert [x for x in resp if x.endswith(os.path.join(test_root, "test_config.cfg"))]
 
+    def test_scan_files(self):
+        self._extract_structure()
+        entries = list(reusables.scan_files(test_structure, name="file_"))
+        assert len(entries) == 4, entries
+        for entry in entries:
+            assert isinstance(entry, reusables.FileEntry)
+            stat = os.stat(entry.path)
+            assert entry.size == stat.st_size
+            assert entry.mtime_ns == stat.st_mtime_ns
+            assert entry.inode == stat.st_ino
+
+    def test_find_files_workers(self):
+        self._extract_structure()
+        single = reusables.find_files_list(test_root, disable_pathlib=True)
+        ordered = reusables.find_files_list(test_root, disable_pathlib=True, workers=4)
+        assert ordered == single, (ordered, single)
+        unordered = reusables.find_files_list(test_root, disable_pathlib=True, workers=4, ordered=False)
+        assert sorted(unordered) == sorted(single)
+        resp = reusables.count_files(test_structure, name="file_", workers=4)
+        assert resp == 4, resp
+        resp2 = reusables.find_files_list(test_structure, depth=2, workers=4)
+        assert len(resp2) == 5, resp2
+
+    def test_find_files_exclude(self):
+        self._extract_structure()
+        everything = reusables.find_files_list(test_structure, disable_pathlib=True)
+        no_files_dir = reusables.find_files_list(test_structure, disable_pathlib=True, exclude_dirs="Files")
+        assert no_files_dir
+        assert not [x for x in no_files_dir if os.sep + "Files" + os.sep in x], no_files_dir
+        assert len(no_files_dir) < len(everything)
+        no_empty = reusables.find_files_list(test_structure, disable_pathlib=True, exclude=["empty*"])
+        assert no_empty
+        assert not [x for x in no_empty if os.path.basename(x).startswith("empty")], no_empty
+
+    def test_file_matcher(self):
+        matcher = reusables.FileMatcher(ext=[".CFG", ".ini"])
+        assert matcher.match("test_config.cfg")
+        assert not matcher.match("test_config.cfg.bak")
+        glob_matcher = reusables.FileMatcher(name="*config*")
+        assert glob_matcher.match("test_config.ini")
+        assert not glob_matcher.match(".config")
+        regex_matcher = reusables.FileMatcher(regex=r"^file_\d$")
+        assert regex_matcher.match("file_1")
+        assert not regex_matcher.match("empty_file_1")
+        self.assertRaises(ValueError, reusables.FileMatcher, name="*.*", match_case=True)
+
+        self._extract_structure()
+        resp = reusables.count_files(test_structure, matcher=regex_matcher)
+        assert resp == len(reusables.find_files_list(test_structure, matcher=regex_matcher))
+        assert resp
+
     def test_path_single(self):
         resp = reusables.safe_path("path")
         assert resp == "path", resp
@@ -178,6 +327,24 @@ Key2 = Value2
         assert not [x for x in delete if "file" not in x.lower()]
         self._remove_structure()
 
+    def test_remove_empty(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, "a", "b", "c"))
+            os.makedirs(os.path.join(tmpdir, "keep"))
+            reusables.touch(os.path.join(tmpdir, "a", "b", "empty"))
+            with open(os.path.join(tmpdir, "keep", "full"), "w") as f:
+                f.write("data")
+            expected = [
+                os.path.join(tmpdir, *parts) for parts in (("a", "b", "empty"), ("a", "b", "c"), ("a", "b"), ("a",))
+            ]
+            assert list(reusables.remove_empty(tmpdir, dry_run=True)) == expected
+            assert os.path.exists(expected[0])
+            assert list(reusables.remove_empty(tmpdir)) == expected
+            assert os.listdir(tmpdir) == ["keep"]
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_extract(self):
         assert os.path.exists(test_structure_tar)
         reusables.extract(test_structure_tar, path=test_root, delete_on_success=False)
@@ -192,6 +359,42 @@ Key2 = Value2
         assert os.path.isdir(test_structure)
         shutil.rmtree(test_structure)
 
+    def test_extract_filters(self):
+        for archive_file in (test_structure_zip, test_structure_tar):
+            for workers in (None, 3):
+                tmpdir = tempfile.mkdtemp()
+                try:
+                    reusables.extract(archive_file, path=tmpdir, name="*/file_*", workers=workers)
+                    found = sorted(os.path.relpath(e.path, tmpdir) for e in reusables.scan_files(tmpdir))
+                    assert found == [os.path.join("test_structure", "Files", n) for n in ("file_1", "file_2")], found
+                    assert not os.path.exists(os.path.join(tmpdir, "test_structure", "empty_2"))
+                    shutil.rmtree(tmpdir)
+
+                    reusables.extract(archive_file, path=tmpdir, max_size=0, workers=workers)
+                    found = sorted(e.name for e in reusables.scan_files(tmpdir))
+                    assert found == ["empty_file", "empty_file_1", "empty_file_2"], found
+
+                    reusables.extract(archive_file, path=tmpdir + "_all", workers=workers)
+                    assert os.path.isdir(os.path.join(tmpdir + "_all", "test_structure", "Empty 3", "empty_3_1"))
+                    assert len(list(reusables.scan_files(tmpdir + "_all"))) == 5
+                finally:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                    shutil.rmtree(tmpdir + "_all", ignore_errors=True)
+
+    def test_iter_archive(self):
+        for archive_file in (test_structure_zip, test_structure_tar):
+            contents = {
+                os.path.basename(getattr(info, "filename", getattr(info, "name", ""))): stream.read()
+                for info, stream in reusables.iter_archive(archive_file)
+            }
+            assert sorted(contents) == ["empty_file", "empty_file_1", "empty_file_2", "file_1", "file_2"], contents
+            assert contents["empty_file"] == b""
+            assert contents["file_1"], contents
+
+            sizes = [info for info, _ in reusables.iter_archive(archive_file, ext="_1", max_size=0)]
+            assert len(sizes) == 1, sizes
+        self.assertRaises(TypeError, lambda: list(reusables.iter_archive(__file__)))
+
     def test_extract_rar(self):
         if reusables.win_based:
             import rarfile
@@ -236,8 +439,29 @@ Key2 = Value2
         dir = tempfile.mkdtemp(suffix="dir1")
         dir2 = tempfile.mkdtemp(suffix="dir2", dir=dir)
         without_files = reusables.os_tree(dir)
-        answer = {dir.replace(tempfile.tempdir, "", 1).lstrip(os.sep): {dir2.lstrip(dir).lstrip(os.sep): {}}}
+        answer = {os.path.basename(dir): {os.path.basename(dir2): {}}}
         assert without_files == answer, "{0} != {1}".format(without_files, answer)
+        shutil.rmtree(dir)
+
+    def test_directory_tree(self):
+        self._extract_structure()
+        tree = reusables.DirectoryTree(test_structure, files=True)
+        assert tree._children is None
+        assert sorted(tree) == ["Empty", "Empty 3", "Files", "empty_1", "empty_2", "files_2"], sorted(tree)
+        assert tree["Files"]._children is None
+        file_1 = tree["Files"]["file_1"]
+        assert isinstance(file_1, reusables.FileEntry)
+        assert file_1.size == os.path.getsize(file_1.path)
+
+        shallow = reusables.os_tree(test_structure, max_depth=1)
+        assert shallow["test_structure"]["empty_1"] == {}, shallow
+        assert shallow["test_structure"]["Files"] == {}, shallow
+
+        sizes = list(tree.sizes())
+        assert sizes[-1] == (test_structure, sum(e.size for e in reusables.scan_files(test_structure)))
+        assert [path for path, _ in reusables.directory_sizes(test_structure, max_depth=0)] == [test_structure]
+        for path, size in sizes:
+            assert size == sum(e.size for e in reusables.scan_files(path)), path
 
     def test_os_tree_bad_dir(self):
         lol_Im_not_a_dir = open("fake_dir", "w")
@@ -379,6 +603,36 @@ Key2 = Value2
             os.unlink(something)
             os.unlink(empty)
 
+    def test_duplicate_index(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            big = os.urandom(200 * 1024)
+            files = {"a": big, "b": big, "c": big[:100000] + b"!" + big[100001:], "d": b"small", "e": b"small"}
+            for name, data in files.items():
+                with open(os.path.join(tmpdir, name), "wb") as f:
+                    f.write(data)
+            reusables.touch(os.path.join(tmpdir, "empty"))
+            index = reusables.DuplicateIndex(tmpdir, workers=2)
+            assert len(index) == 6, index
+
+            def names(path):
+                return sorted(os.path.basename(x) for x in index.find_duplicates_of(os.path.join(tmpdir, path)))
+
+            assert names("a") == ["a", "b"]
+            assert names("c") == ["c"]
+            assert names("d") == ["d", "e"]
+            assert names("empty") == ["empty"]
+            assert len(index._digests) == 3, "c, a and b should only be fully hashed once"
+            assert names("b") == ["a", "b"]
+            assert len(index._digests) == 3
+
+            with open(os.path.join(tmpdir, "new_file"), "wb") as f:
+                f.write(big)
+            found = list(reusables.dup_finder(os.path.join(tmpdir, "new_file"), index=index))
+            assert sorted(os.path.basename(x) for x in found) == ["a", "b"], found
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_cut(self):
         a = reusables.cut("abcdefghi")
         assert a == ["ab", "cd", "ef", "gh", "i"]
@@ -426,6 +680,135 @@ Key2 = Value2
         assert os.path.exists(p4)
         os.unlink(p4)
 
+    def test_archive_workers(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmpdir, "source")
+            os.mkdir(source)
+            files = {"big": os.urandom(1024 * 1024) + b"repeat" * 500000, "small": b"small", "empty": b""}
+            for name, data in files.items():
+                with open(os.path.join(source, name), "wb") as f:
+                    f.write(data)
+            for name in ("parallel.zip", "parallel.tar.gz", "parallel.tar.bz2"):
+                archive = reusables.archive(source, name=os.path.join(tmpdir, name), workers=4)
+                if name.endswith("zip"):
+                    with zipfile.ZipFile(archive) as zip_file:
+                        assert zip_file.testzip() is None
+                        assert len(zip_file.infolist()) == 3
+                        assert zip_file.read(zip_file.infolist()[0]) in files.values()
+                out = os.path.join(tmpdir, name + "_out")
+                reusables.extract(archive, path=out)
+                for file_name, data in files.items():
+                    with open(os.path.join(out, source.lstrip(os.sep), file_name), "rb") as f:
+                        assert f.read() == data, (name, file_name)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_archive_stream(self):
+        class Unseekable(object):
+            def __init__(self):
+                self.data = io.BytesIO()
+
+            def write(self, data):
+                return self.data.write(data)
+
+            def flush(self):
+                pass
+
+        chunks = []
+
+        def sink():
+            while True:
+                chunks.append((yield))
+
+        self._extract_structure()
+        expected = sorted(entry.path for entry in reusables.scan_files(test_structure))
+        for archive_type in ("zip", "gz", "bz2"):
+            for workers in (None, 3):
+                out = Unseekable()
+                assert reusables.archive(test_structure, out, archive_type=archive_type, workers=workers) is out
+                chunks[:] = []
+                reusables.archive(test_structure, sink(), archive_type=archive_type, workers=workers)
+                for data in (out.data.getvalue(), b"".join(chunks)):
+                    if archive_type == "zip":
+                        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                            assert zip_file.testzip() is None
+                            names = zip_file.namelist()
+                    else:
+                        with tarfile.open(fileobj=io.BytesIO(data)) as tar_file:
+                            names = tar_file.getnames()
+                    assert sorted(names) == [path.lstrip(os.sep) for path in expected], (archive_type, names)
+        self._remove_structure()
+
+    def test_archive_update(self):
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(tmpdir)
+            os.mkdir("src")
+            for name, data in (("a", b"aaaa"), ("b", b"bbbb"), ("same_1", b"same" * 100), ("same_2", b"same" * 100)):
+                with open(os.path.join("src", name), "wb") as f:
+                    f.write(data)
+            for name in ("snap.zip", "snap.tar"):
+                reusables.archive("src", name=name)
+                with open(name, "rb") as f:
+                    original = f.read()
+                reusables.archive("src", name=name, update=True)
+                touched = os.path.getmtime(os.path.join("src", "a")) + 10
+                os.utime(os.path.join("src", "a"), (touched, touched))
+                reusables.archive("src", name=name, update=True)
+                if name.endswith("zip"):
+                    with open(name, "rb") as f:
+                        assert f.read() == original, "Unchanged and touched files should not be added again"
+
+                with open(os.path.join("src", "b"), "wb") as f:
+                    f.write(b"changed b")
+                with open(os.path.join("src", "c"), "wb") as f:
+                    f.write(b"new c")
+                reusables.archive("src", name=name, update=True, workers=2)
+                contents = {}
+                for info, stream in reusables.iter_archive(name):
+                    contents[getattr(info, "filename", None) or info.name] = stream.read()
+                assert contents[os.path.join("src", "b")] == b"changed b", contents
+                assert contents[os.path.join("src", "c")] == b"new c", contents
+                assert contents[os.path.join("src", "a")] == b"aaaa", contents
+                if name.endswith("zip"):
+                    with zipfile.ZipFile(name) as zip_file:
+                        assert zip_file.testzip() is None
+                        assert len(zip_file.namelist()) == 5, zip_file.namelist()
+                else:
+                    assert len(contents) == 5, contents
+                os.unlink(os.path.join("src", "c"))
+                with open(os.path.join("src", "b"), "wb") as f:
+                    f.write(b"bbbb")
+
+            # Only new files, appended to the zip in place by multiple workers
+            reusables.archive("src", name="snap.zip", update=True)
+            with open(os.path.join("src", "d"), "wb") as f:
+                f.write(b"new d" * 1000)
+            reusables.archive("src", name="snap.zip", update=True, workers=2)
+            with zipfile.ZipFile("snap.zip") as zip_file:
+                assert zip_file.testzip() is None
+                assert zip_file.read(os.path.join("src", "d")) == b"new d" * 1000
+                assert len(zip_file.namelist()) == 6, zip_file.namelist()
+            os.unlink(os.path.join("src", "d"))
+
+            reusables.archive("src", name="snap.tar.gz")
+            self.assertRaises(ValueError, reusables.archive, "src", name="snap.tar.gz", update=True)
+            self.assertRaises(ValueError, reusables.archive, "src", name="dedupe.zip", dedupe=True)
+
+            reusables.archive("src", name="dedupe.tar.gz", dedupe=True)
+            with tarfile.open("dedupe.tar.gz") as tar_file:
+                links = [member.name for member in tar_file if member.islnk()]
+            assert len(links) == 1, links
+            reusables.extract("dedupe.tar.gz", path="out")
+            for name in ("same_1", "same_2"):
+                with open(os.path.join("out", "src", name), "rb") as f:
+                    assert f.read() == b"same" * 100
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
     def test_bad_archive_type(self):
         try:
             reusables.archive("__init__.py", archive_type="rar")
@@ -441,10 +824,72 @@ Key2 = Value2
         else:
             raise AssertionError("You cant figure out that archive type ")
 
-    #
-    # def test_duplicate_dir(self):
-    #     dups = reusables.directory_duplicates(test_root)
-    #     assert len(dups) == 1, len(dups)
+    def test_directory_duplicates(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            big = os.urandom(300 * 1024)
+            files = {
+                "a": b"same content",
+                "b": b"same content",
+                "c": b"same size xyz",
+                "d": big,
+                "e": big,
+                "f": big[:-1] + b"!",
+                "g": big[:150000] + b"!" + big[150001:],
+            }
+            for name, data in files.items():
+                with open(os.path.join(tmpdir, name), "wb") as f:
+                    f.write(data)
+            for workers, executor in ((None, "thread"), (4, "thread"), (2, "process")):
+                stats = {}
+                dups = reusables.directory_duplicates(tmpdir, workers=workers, executor=executor, stats=stats)
+                dups = sorted(sorted(os.path.basename(x) for x in group) for group in dups)
+                assert dups == [["a", "b"], ["d", "e"]], dups
+                assert stats["files"] == 7, stats
+                assert stats["size_eliminated"] == 1, stats
+                assert stats["partial_eliminated"] == 1, stats
+                assert stats["full_eliminated"] == 1, stats
+                assert stats["duplicates"] == 4, stats
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_duplicates_hardlinks(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ("a", "b"):
+                with open(os.path.join(tmpdir, name), "wb") as f:
+                    f.write(b"same content")
+            os.link(os.path.join(tmpdir, "a"), os.path.join(tmpdir, "c"))
+            stats, hardlinks = {}, []
+            dups = reusables.directory_duplicates(tmpdir, stats=stats, hardlinks=hardlinks)
+            assert len(dups) == 1 and len(dups[0]) == 2, dups
+            assert os.path.join(tmpdir, "b") in dups[0]
+            assert [sorted(os.path.basename(x) for x in group) for group in hardlinks] == [["a", "c"]], hardlinks
+            assert stats["hardlinks"] == 1 and stats["duplicates"] == 2, stats
+
+            index = reusables.DuplicateIndex(tmpdir)
+            assert sorted(index.hardlinks_of(os.path.join(tmpdir, "c"))) == [
+                os.path.join(tmpdir, "a"),
+                os.path.join(tmpdir, "c"),
+            ]
+            found = index.find_duplicates_of(os.path.join(tmpdir, "a"))
+            assert sorted(os.path.basename(x) for x in found) == ["a", "b"], found
+
+            self.assertRaises(ValueError, reusables.dedupe, dups, action="symlink")
+            dups = [[os.path.join(tmpdir, "a"), os.path.join(tmpdir, "b")]]
+            assert reusables.dedupe(dups, dry_run=True) == [dups[0][1]]
+            assert reusables.dedupe(dups) == [dups[0][1]]
+            assert os.path.samefile(os.path.join(tmpdir, "a"), os.path.join(tmpdir, "b"))
+            assert sorted(os.listdir(tmpdir)) == ["a", "b", "c"]
+            assert reusables.directory_duplicates(tmpdir) == []
+            assert reusables.dedupe(dups) == []
+
+            missing = [[os.path.join(tmpdir, "a"), os.path.join(tmpdir, "missing")]]
+            assert reusables.dedupe(missing) == []
+            assert reusables.dedupe(missing, dry_run=True) == []
+            self.assertRaises(OSError, reusables.dedupe, missing, ignore_errors=False)
+        finally:
+            shutil.rmtree(tmpdir)
 
     @pytest.mark.filterwarnings('ignore:"enable_scandir"')
     def test_find(self):
@@ -458,6 +903,205 @@ Key2 = Value2
         assert not [x for x in delete if "empty" not in x.lower()]
         self._remove_structure()
 
+    def test_copy_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(3 * 1024 * 1024 + 7)
+            source = os.path.join(tmpdir, "source")
+            with open(source, "wb") as f:
+                f.write(data)
+            os.chmod(source, 0o640)
+            assert reusables.copy_file(source, os.path.join(tmpdir, "clone")) == len(data)
+            assert reusables.copy_file(source, os.path.join(tmpdir, "copy"), reflink=False) == len(data)
+            for name in ("clone", "copy"):
+                with open(os.path.join(tmpdir, name), "rb") as f:
+                    assert f.read() == data
+                if reusables.nix_based:
+                    assert os.stat(os.path.join(tmpdir, name)).st_mode == os.stat(source).st_mode
+
+            results = list(
+                reusables.copy_files(
+                    [
+                        (source, os.path.join(tmpdir, "one")),
+                        (os.path.join(tmpdir, "missing"), os.path.join(tmpdir, "two")),
+                    ],
+                    workers=2,
+                )
+            )
+            results.sort(key=lambda result: result.destination)
+            assert [(r.status, r.bytes_copied) for r in results] == [("copied", len(data)), ("failed", 0)], results
+            assert isinstance(results[1].error, OSError)
+
+            self.assertRaises(shutil.SameFileError, reusables.copy_file, source, source)
+            (result,) = reusables.copy_files([(source, source)])
+            assert result.status == "failed" and isinstance(result.error, shutil.SameFileError), result
+            with open(source, "rb") as f:
+                assert f.read() == data
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_delta_copy(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(10 * 1000)
+            source, destination = os.path.join(tmpdir, "source"), os.path.join(tmpdir, "destination")
+            with open(source, "wb") as f:
+                f.write(data)
+            with open(destination, "wb") as f:
+                f.write(data[:3000] + b"x" * 1000 + data[4000:8500])
+            written = reusables.delta_copy(source, destination, block_size=1000)
+            assert written == 1000 + 1000 + 1000, written  # changed block, short block and the missing block
+            with open(destination, "rb") as f:
+                assert f.read() == data
+
+            with open(destination, "ab") as f:
+                f.write(b"extra")
+            assert reusables.delta_copy(source, destination, block_size=1000) == 0
+            assert os.path.getsize(destination) == len(data)
+
+            source_dir, synced = os.path.join(tmpdir, "source_dir"), os.path.join(tmpdir, "synced")
+            os.mkdir(source_dir)
+            source = os.path.join(source_dir, "source")
+            with open(source, "wb") as f:
+                f.write(os.urandom(3 * 1024 * 1024))
+            reusables.sync_dirs(source_dir, synced)
+            with open(os.path.join(synced, "source"), "r+b") as f:
+                f.seek(1024 * 1024 + 5)
+                f.write(b"changed")
+            results = reusables.sync_dirs(source_dir, synced, overwrite=True, delta=True)
+            assert [(r.status, r.bytes_copied) for r in results] == [("delta", 1024 * 1024)], results
+            assert reusables.file_hash(os.path.join(synced, "source")) == reusables.file_hash(source)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sync_plan(self):
+        self._extract_structure()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            plan = reusables.plan_sync(test_structure, tmpdir)
+            assert plan.totals["copy"]["files"] == 5, plan.totals
+            assert plan.totals["copy"]["bytes"] == sum(e.size for e in reusables.scan_files(test_structure))
+            assert not os.listdir(tmpdir), "Planning should not change anything"
+            results = plan.execute(workers=2)
+            assert [r.status for r in results] == ["copied"] * 5, results
+
+            extra_dir = os.path.join(tmpdir, "extra")
+            os.mkdir(extra_dir)
+            reusables.touch(os.path.join(extra_dir, "only_in_destination"))
+            plan = reusables.plan_sync(test_structure, tmpdir, delete=True)
+            assert plan.totals["skip"]["files"] == 5, plan.totals
+            assert [op.destination for op in plan.by_action("delete")] == [
+                os.path.join(extra_dir, "only_in_destination")
+            ]
+            plan.execute()
+            assert not os.path.exists(extra_dir)
+
+            other = tempfile.mkdtemp()
+            with open(os.path.join(other, "new_file"), "w") as f:
+                f.write("two way")
+            reusables.sync_dirs(tmpdir, other, two_way=True)
+            assert os.path.exists(os.path.join(tmpdir, "new_file"))
+            assert os.path.exists(os.path.join(other, "Files", "file_1"))
+            shutil.rmtree(other)
+            self.assertRaises(ValueError, reusables.plan_sync, tmpdir, other, delete=True, two_way=True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_snapshot_diff(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ("keep", "change", "remove", "move"):
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(name)
+            before = reusables.snapshot(tmpdir)
+            assert [entry.path for entry in before] == ["change", "keep", "move", "remove"]
+            before.save(os.path.join(tmpdir, "snapshot.json"))
+            assert list(reusables.diff(before, reusables.Snapshot.load(os.path.join(tmpdir, "snapshot.json")))) == []
+            os.unlink(os.path.join(tmpdir, "snapshot.json"))
+
+            with open(os.path.join(tmpdir, "change"), "w") as f:
+                f.write("changed")
+            os.unlink(os.path.join(tmpdir, "remove"))
+            os.mkdir(os.path.join(tmpdir, "sub"))
+            os.rename(os.path.join(tmpdir, "move"), os.path.join(tmpdir, "sub", "moved"))
+            with open(os.path.join(tmpdir, "new"), "w") as f:
+                f.write("new")
+
+            changes = [(change.action, change.path) for change in reusables.diff(before, reusables.snapshot(tmpdir))]
+            assert changes == [
+                ("modified", "change"),
+                ("moved", os.path.join("sub", "moved")),
+                ("removed", "remove"),
+                ("added", "new"),
+            ], changes
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_watch(self):
+        for polling in (False, True):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                os.makedirs(os.path.join(tmpdir, "d1", "deep"))
+                moved = [os.path.join("d1", "f.txt"), os.path.join("d1", "deep", "g.txt")]
+                for name in moved:
+                    reusables.touch(os.path.join(tmpdir, name))
+
+                def make_changes():
+                    time.sleep(0.3)
+                    os.mkdir(os.path.join(tmpdir, "sub"))
+                    with open(os.path.join(tmpdir, "sub", "a.txt"), "w") as f:
+                        f.write("a")
+                    reusables.touch(os.path.join(tmpdir, "b.log"))
+                    time.sleep(0.3)
+                    os.unlink(os.path.join(tmpdir, "sub", "a.txt"))
+                    os.rename(os.path.join(tmpdir, "d1"), os.path.join(tmpdir, "d2"))
+
+                changes = threading.Thread(target=make_changes)
+                changes.start()
+                events = list(reusables.watch(tmpdir, ext=".txt", interval=0.1, timeout=1, polling=polling))
+                changes.join()
+                a_file = os.path.join(tmpdir, "sub", "a.txt")
+                a_events = [event for event in events if event.path == a_file]
+                assert a_events[0] == ("created", a_file), events
+                assert a_events[-1] == ("deleted", a_file), events
+
+                others = sorted(event for event in events if event.path != a_file)
+                assert others == sorted(
+                    [("deleted", os.path.join(tmpdir, name)) for name in moved]
+                    + [("created", os.path.join(tmpdir, "d2", name[3:])) for name in moved]
+                ), (polling, others)
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def test_sync_dirs_manifest(self):
+        from unittest import mock
+
+        self._extract_structure()
+        tmpdir = tempfile.mkdtemp()
+        manifest = os.path.join(tmpdir, "manifest.json")
+        destination = os.path.join(tmpdir, "dest")
+        try:
+            reusables.sync_dirs(test_structure, destination, manifest=manifest)
+            assert len(reusables.load_json(manifest)) == 5
+            synced = reusables.load_json(manifest)
+            reusables.sync_dirs(test_structure, destination, manifest=manifest, checksums=False)
+            assert reusables.load_json(manifest) == synced, "Syncing without checksums should keep the manifest"
+            with mock.patch("reusables.file_operations.file_hash") as hashed:
+                reusables.sync_dirs(test_structure, destination, manifest=manifest)
+                assert not hashed.called
+
+            changed = os.path.join(destination, "Files", "file_1")
+            with open(changed, "r+b") as f:
+                f.write(b"!")
+            reusables.sync_dirs(test_structure, destination, overwrite=True, manifest=manifest)
+            with open(changed, "rb") as f:
+                assert not f.read().startswith(b"!")
+            with mock.patch("reusables.file_operations.file_hash") as hashed:
+                reusables.sync_dirs(test_structure, destination, manifest=manifest)
+                assert not hashed.called
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_find_file_pathlib(self):
         if reusables.python_version >= (3, 4):
             import pathlib
@@ -472,6 +1116,25 @@ Key2 = Value2
             pass
         reusables.find_files_list(test_root, ext=".cfg", abspath=True)
 
+    def test_sync_dirs_checksums(self):
+        self._extract_structure()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            reusables.sync_dirs(test_structure, tmpdir)
+            source = reusables.find_files_list(test_structure, disable_pathlib=True)
+            synced = reusables.find_files_list(tmpdir, disable_pathlib=True)
+            assert len(source) == len(synced), synced
+            changed = os.path.join(tmpdir, "Files", "file_1")
+            original = reusables.file_hash(os.path.join(test_structure, "Files", "file_1"))
+            with open(changed, "r+b") as f:
+                data = f.read()
+                f.seek(0)
+                f.write(bytes(len(data)))
+            reusables.sync_dirs(test_structure, tmpdir, overwrite=True, workers=2)
+            assert reusables.file_hash(changed) == original
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if reusables.nix_based:
 